@@ -2,10 +2,23 @@
 
 import unittest
 import os
+import sys
 import contextlib
 from redis import ResponseError
 
+from rmtest.batch import Batch
+from rmtest.benchmark import run_benchmark, compare_client_modes, \
+    baseline_for, LATENCY_METRICS
 from rmtest.disposableredis import DisposableRedis
+from rmtest.disposableredis.bulk import bulk_load
+from rmtest.disposableredis.load import run_load
+from rmtest.disposableredis.memory import MemoryTracker, memory_reading, \
+    bytes_per_key, is_monotonic_growth, safe_record
+from rmtest.disposableredis.cache import cache_root, args_digest, \
+    build_digest, source_digest, publish_file
+from rmtest.pool import WARM_POOL
+from rmtest.shared import SHARED_SERVERS, needs_fresh_server
+from rmtest.stats import COMMAND_STATS, snapshot_safely, diff
 from rmtest import config
 
 REDIS_MODULE_PATH_ENVVAR = 'REDIS_MODULE_PATH'
@@ -19,16 +32,52 @@ class BaseModuleTestCase(unittest.TestCase):
     settings can be defined either directly via the config module (see the
     config.py file), or via the rmtest.config file in the current directoy (i.e.
     of the process, not the file), or via environment variables.
+
+    Set `reuse_server` (or REDIS_REUSE_SERVER) to share one server per argument
+    signature across the whole session. Tests which need their own process can
+    be decorated with `needs_fresh_server`. Those, and every test when reuse is
+    off, take a pre-started server from the warm pool if REDIS_WARM_POOL is set.
+    List the module INFO fields that hold state surviving FLUSHALL in
+    `module_state_fields`; a shared server whose values differ after a test is
+    restarted.
+
+    With `capture_command_stats` (or RMTEST_COMMAND_STATS) the server-side
+    command statistics and slowlog entries of each test are stored in its
+    `command_stats` attribute and summarized at exit.
+
+    With `track_memory` (or RMTEST_TRACK_MEMORY) `self.memory` records memory
+    readings at the start and end of the test and around every reload.
+
+    `client_mode` (or REDIS_CLIENT_MODE) selects how `self.client` returns
+    replies: 'decoded' to str, 'raw' bytes, or bytes parsed by 'hiredis'.
     """
 
+    reuse_server = config.REDIS_REUSE_SERVER
+    module_state_fields = ()
+    client_mode = config.REDIS_CLIENT_MODE
+    capture_command_stats = config.RMTEST_COMMAND_STATS
+    track_memory = config.RMTEST_TRACK_MEMORY
+
     def tearDown(self):
         if hasattr(self, '_server'):
-            self._server.stop()
-            self._server = None
-            self._client = None
+            self._record_command_stats()
+            self._finish_memory_tracking()
+            self._release_server()
 
         super(BaseModuleTestCase, self).tearDown()
 
+    def _release_server(self):
+        if getattr(self, '_server', None):
+            self._server.memory_tracker = None
+            if getattr(self, '_shared', False):
+                SHARED_SERVERS.release(self._server, self.module_state_is_clean,
+                                       self.module_state_fields)
+            else:
+                self._server.stop()
+        self._server = None
+        self._client = None
+        self._shared = False
+
     @property
     def server(self):
         self._ensure_server()
@@ -46,14 +95,104 @@ class BaseModuleTestCase(unittest.TestCase):
 
     def restart_and_reload(self):
         self._server.dump_and_reload(restart_process=True)
-        self._client = self._server.client()
+        self._client = self._server.client(self.client_mode)
+
+    def load_fixture(self, seed, link='copy'):
+        """
+        Populate the server with the dataset created by `seed(self)`.
+
+        The first run saves the dataset as an RDB file in the fixture cache,
+        keyed by the source of `seed`, the redis binary, the module and the
+        server arguments. Later runs start a fresh server directly from that
+        file, copied (or `link='hardlink'`/`'symlink'`) into place, so the
+        dataset loads at RDB speed instead of being seeded again.
+
+        The memory used by the dataset, including `bytes_per_key`, is stored in
+        `self.fixture_memory`.
+        """
+        if self.is_external_server:
+            seed(self)
+            return
+
+        candidate = self.redis()
+        path = cache_root('fixtures', '%s.rdb' % args_digest([
+            source_digest(seed),
+            build_digest(candidate.path, candidate._init_args.get('loadmodule')),
+            candidate.signature]))
+
+        if os.path.exists(path):
+            self._release_server()
+            candidate.preload_rdb(path, link)
+            candidate.start()
+            self._server = candidate
+            self._client = candidate.client(self.client_mode)
+            # the snapshots taken so far belong to the released server
+            self._start_tracking()
+        else:
+            self._ensure_server()
+            seed(self)
+            self._client.save()
+            publish_file(self._server.rdb_path, path)
+
+        self.fixture_memory = memory_reading(self._client)
+        self.fixture_memory['bytes_per_key'] = bytes_per_key(self.fixture_memory)
 
     def _ensure_server(self, **kwargs):
         if getattr(self, '_server', None):
             return
         self._server = self.redis(**kwargs)
-        self._server.start()
-        self._client = self._server.client()
+        if self._can_share_server():
+            self._server = SHARED_SERVERS.acquire(self._server)
+            self._shared = True
+        else:
+            self._server = WARM_POOL.acquire(self._server)
+            self._shared = False
+        self._client = self._server.client(self.client_mode)
+        self._start_tracking()
+
+    def _start_tracking(self):
+        if self.capture_command_stats:
+            self._stats_before = snapshot_safely(self._client)
+        if self.track_memory:
+            self._start_memory_tracking()
+
+    def _start_memory_tracking(self):
+        self.memory = MemoryTracker(self._server.client)
+        self._server.memory_tracker = self.memory
+        safe_record(self.memory, 'start')
+
+    def _finish_memory_tracking(self):
+        memory = getattr(self, 'memory', None)
+        if memory is None or not getattr(self, '_server', None):
+            return
+        safe_record(memory, 'end')
+        memory.check()
+
+    def _record_command_stats(self):
+        before = getattr(self, '_stats_before', None)
+        if before is None or not getattr(self, '_server', None):
+            return
+        self._stats_before = None
+        after = snapshot_safely(self._server.client())
+        if after is not None:
+            self.command_stats = diff(before, after)
+            COMMAND_STATS.add(self.id(), self.command_stats)
+
+    def _can_share_server(self):
+        if not self.reuse_server or self.is_external_server:
+            return False
+        method = getattr(self, self._testMethodName, None)
+        return not (getattr(self, 'rmtest_fresh_server', False) or
+                    getattr(method, 'rmtest_fresh_server', False))
+
+    def module_state_is_clean(self, client):
+        """
+        Called on a shared server after it has been flushed and compared with
+        the modules and `module_state_fields` it started with (see
+        `rmtest.shared`). Override to check for module state that neither
+        reveals; returning False restarts the server before the next test.
+        """
+        return True
 
     @property
     def module_args(self):
@@ -83,6 +222,7 @@ class BaseModuleTestCase(unittest.TestCase):
         """
         if not config.REDIS_MODULE:
             raise Exception('No module specified. Use config file or environment!')
+        redis_args.setdefault('unixsocket', config.REDIS_UNIXSOCKET)
         redis_args.update(self.server_args)
         redis_args.update(
             {'loadmodule': [config.REDIS_MODULE] + self.module_args})
@@ -91,6 +231,104 @@ class BaseModuleTestCase(unittest.TestCase):
     def cmd(self, *args, **kwargs):
         return self.client.execute_command(*args, **kwargs)
 
+    def bulk_load(self, commands, **kwargs):
+        """
+        Stream an iterable of commands into the server in large batches. See
+        `rmtest.disposableredis.bulk.bulk_load` for the options.
+        """
+        return bulk_load(self.client, commands, **kwargs)
+
+    def run_load(self, mix, **options):
+        """
+        Drive the server with concurrent clients in worker processes. See
+        `rmtest.disposableredis.load.run_load` for the options.
+
+        :rtype: rmtest.disposableredis.load.LoadResult
+        """
+        return run_load(self.server, mix, **options)
+
+    def benchmark(self, *args, **options):
+        """
+        Run a command repeatedly and return its latency percentiles and
+        throughput. See `rmtest.benchmark.run_benchmark` for the options
+        (iterations, warmup, pipeline, rounds, name).
+
+        :rtype: rmtest.benchmark.BenchmarkResult
+        """
+        return run_benchmark(self.client, args, **options)
+
+    def benchmark_client_modes(self, *args, **options):
+        """
+        Benchmark a command in every available client mode, to compare the
+        cost of parsing its reply. See `rmtest.benchmark.compare_client_modes`.
+
+        :return: OrderedDict of mode -> BenchmarkResult
+        """
+        return compare_client_modes(self.server, args, **options)
+
+    def _check_baseline(self, result, metrics):
+        test_file = sys.modules[type(self).__module__].__file__
+        key = '%s:%s' % (self.id(), result.name)
+        regressions = baseline_for(test_file).check(key, result, metrics)
+        if regressions:
+            self.fail('\n'.join(regressions))
+
+    def assertLatency(self, args, below_ms=None, percentile='p99',
+                      baseline=True, **options):
+        """
+        Benchmark the command `args` and fail if the given latency percentile
+        ('p50', 'p95', 'p99' or 'max') exceeds `below_ms` milliseconds, or
+        regresses against the baseline file.
+        """
+        if percentile not in LATENCY_METRICS:
+            raise ValueError('Unknown latency percentile %r' % percentile)
+        result = self.benchmark(*args, **options)
+        if below_ms is not None and result.ms(percentile) > below_ms:
+            self.fail('%s %s latency %.3fms exceeds %.3fms' % (
+                result.name, percentile, result.ms(percentile), below_ms))
+        if baseline:
+            self._check_baseline(result, (percentile,))
+        return result
+
+    def assertThroughput(self, args, min_ops=None, baseline=True, **options):
+        """
+        Benchmark the command `args` and fail if it runs at fewer than
+        `min_ops` operations per second, or regresses against the baseline
+        file.
+        """
+        result = self.benchmark(*args, **options)
+        if min_ops is not None and result.ops_per_sec < min_ops:
+            self.fail('%s throughput %.0f ops/sec is below %.0f' % (
+                result.name, result.ops_per_sec, min_ops))
+        if baseline:
+            self._check_baseline(result, ('ops_per_sec',))
+        return result
+
+    def assertMemoryBelow(self, limit, metric='used_memory', msg=None):
+        """
+        Assert that the server's `metric` from INFO memory (in bytes, or a
+        ratio for the fragmentation metrics) is at most `limit`
+        """
+        value = memory_reading(self.client)[metric]
+        if value > limit:
+            self.fail(msg or '%s is %s, above the limit of %s' % (
+                metric, value, limit))
+
+    def assertNoLeakAcrossReloads(self, n=5, min_growth=1 << 16,
+                                  metric='used_memory'):
+        """
+        Dump and reload the dataset `n` times and fail if `metric` grew after
+        every single reload, by more than `min_growth` bytes in total
+        """
+        values = []
+        for _ in range(n):
+            self.server.dump_and_reload()
+            values.append(memory_reading(self.client)[metric])
+        if is_monotonic_growth(values, min_growth):
+            self.fail('%s grew after each of %d reloads: %s' % (
+                metric, n, ', '.join(str(v) for v in values)))
+        return values
+
     def assertOk(self, oks, msg=None):
         if isinstance(oks, (bytes, bytearray)):
             self.assertEqual(b"OK", oks, msg)
@@ -119,8 +357,40 @@ class BaseModuleTestCase(unittest.TestCase):
         c, s = self.client, self.server
         self.assertEqual(True, self.cmd('PING'))
     
-    def retry_with_reload(self):
-        return self.client.retry_with_rdb_reload()
+    def retry_with_reload(self, verify=False, strategy=None):
+        return self.client.retry_with_rdb_reload(verify, strategy)
+
+    def assertDatasetSurvives(self, *strategies, **kwargs):
+        """
+        Run a digest-verified persistence round-trip for each strategy ('rdb'
+        by default; 'aof' and 'dump' as well), failing with the changed keys
+        if the dataset differs afterwards. Pass `restart=True` to reload by
+        restarting the server process.
+
+        :return: the `RoundTrip` of each strategy, with its save and load times
+        """
+        restart = kwargs.pop('restart', False)
+        return [self.server.dump_and_reload(restart_process=restart,
+                                            verify=True, strategy=strategy)
+                for strategy in strategies or ('rdb',)]
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Queue command assertions and check them all at the end of the block,
+        sending the commands in a single pipeline. Every mismatch is reported
+        with the index of its command.
+
+        For Example:
+
+            with self.batch() as b:
+                b.assertCmdOk('mymodule.set', 'key', 'value')
+                b.assertEqual('value', 'mymodule.get', 'key')
+                b.assertResponseError('mymodule.get')
+        """
+        batch = Batch(self, self.client)
+        yield batch
+        batch.verify()
 
     @contextlib.contextmanager
     def assertResponseError(self, msg=None):
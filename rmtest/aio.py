@@ -0,0 +1,84 @@
+# pylint: disable=missing-docstring, invalid-name, attribute-defined-outside-init
+
+"""
+asyncio version of `BaseModuleTestCase`, built on
+`unittest.IsolatedAsyncioTestCase` (Python 3.8+).
+"""
+
+import unittest
+
+from rmtest import BaseModuleTestCase
+from rmtest import config
+from rmtest.disposableredis.aio import AsyncDisposableRedis
+
+
+class AsyncModuleTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    Each test gets its own `AsyncDisposableRedis`, started in asyncSetUp and
+    configured exactly like `BaseModuleTestCase`. Commands are coroutines:
+
+        async def testCmd(self):
+            self.assertOk(await self.cmd('mymodule.dosomething'))
+    """
+
+    client_mode = config.REDIS_CLIENT_MODE
+    module_args = BaseModuleTestCase.module_args
+    server_args = BaseModuleTestCase.server_args
+    is_external_server = BaseModuleTestCase.is_external_server
+
+    async def asyncSetUp(self):
+        await super(AsyncModuleTestCase, self).asyncSetUp()
+        self._server = self.redis()
+        await self._server.start()
+        self._client = self._server.aclient()
+
+    async def asyncTearDown(self):
+        if getattr(self, '_server', None):
+            await self._server.stop()
+            self._server = None
+            self._client = None
+        await super(AsyncModuleTestCase, self).asyncTearDown()
+
+    @property
+    def server(self):
+        return self._server
+
+    @property
+    def client(self):
+        return self._client
+
+    def aclient(self):
+        """
+        Return another async client sharing the server's connection pool
+        """
+        return self._server.aclient()
+
+    async def restart_and_reload(self):
+        await self._server.dump_and_reload(restart_process=True)
+        self._client = self._server.aclient()
+
+    def redis(self, **redis_args):
+        if not config.REDIS_MODULE:
+            raise Exception('No module specified. Use config file or environment!')
+        redis_args.setdefault('unixsocket', config.REDIS_UNIXSOCKET)
+        redis_args.setdefault('client_mode', self.client_mode)
+        redis_args.update(self.server_args)
+        redis_args.update(
+            {'loadmodule': [config.REDIS_MODULE] + self.module_args})
+        return AsyncDisposableRedis(port=config.REDIS_PORT,
+                                    path=config.REDIS_BINARY, **redis_args)
+
+    async def cmd(self, *args, **kwargs):
+        return await self._client.execute_command(*args, **kwargs)
+
+    async def assertCmdOk(self, cmd, *args, **kwargs):
+        self.assertOk(await self.cmd(cmd, *args, **kwargs))
+
+    assertOk = BaseModuleTestCase.assertOk
+    assertResponseError = BaseModuleTestCase.assertResponseError
+
+    async def assertExists(self, r, key, msg=None):
+        self.assertTrue(await r.exists(key), msg)
+
+    async def assertNotExists(self, r, key, msg=None):
+        self.assertFalse(await r.exists(key), msg)
@@ -0,0 +1,157 @@
+# pylint: disable=missing-docstring, invalid-name
+
+"""
+Pipelined batches of command assertions.
+
+Inside `with self.batch() as b:` commands are queued together with the reply
+they should produce; nothing is sent until the block ends. All commands then
+go out in one non-transactional pipeline (against a cluster, one pipeline per
+node, sent concurrently, with every command routed by the slot of its key)
+and every reply is checked, so a single failure lists all the mismatches,
+each with the index of its command in the batch.
+
+Only `ResponseError` replies count as the errors expected by
+`assertResponseError`; any other error is raised as is.
+"""
+
+from redis import ResponseError
+
+from rmtest.disposableredis.cluster import Cluster
+
+_ANY = object()
+
+
+class BatchEntry(object):
+
+    def __init__(self, index, args, options, expected=_ANY, ok=False,
+                 error=False, msg=None):
+        self.index = index
+        self.args = args
+        self.options = options
+        self.expected = expected
+        self.ok = ok
+        self.error = error
+        self.msg = msg
+
+    def __repr__(self):
+        return '#%d %s' % (self.index, ' '.join(str(a) for a in self.args))
+
+
+def _send(client, entries):
+    pipe = client.pipeline(transaction=False)
+    for entry in entries:
+        pipe.execute_command(*entry.args, **entry.options)
+    return pipe.execute(raise_on_error=False)
+
+
+class Batch(object):
+    """
+    Queue of commands and expectations, sent and checked by `verify()`.
+    Every method takes an optional `msg`, added to the report of its entry.
+    """
+
+    def __init__(self, testcase, target, key_index=1):
+        """
+        :param testcase: the test case whose assertions check the replies
+        :param target: a redis client, or a `Cluster`
+        :param key_index: position of the key in each command, used to route
+            commands to cluster nodes; commands without one go to the first
+            node
+        """
+        self._testcase = testcase
+        self._target = target
+        self._key_index = key_index
+        self.entries = []
+        # replies in queue order, once sent
+        self.replies = None
+
+    def _queue(self, args, options, **expectation):
+        entry = BatchEntry(len(self.entries), args, options,
+                           msg=options.pop('msg', None), **expectation)
+        self.entries.append(entry)
+        return entry
+
+    def cmd(self, *args, **kwargs):
+        """
+        Queue a command whose reply is not checked; it only must not fail
+        """
+        return self._queue(args, kwargs)
+
+    def assertCmdOk(self, *args, **kwargs):
+        return self._queue(args, kwargs, ok=True)
+
+    def assertEqual(self, expected, *args, **kwargs):
+        """
+        Queue a command which should reply `expected`
+        """
+        return self._queue(args, kwargs, expected=expected)
+
+    def assertResponseError(self, *args, **kwargs):
+        """
+        Queue a command which should fail with a redis error response
+        """
+        return self._queue(args, kwargs, error=True)
+
+    def _send_cluster(self, cluster):
+        groups = {}
+        for entry in self.entries:
+            if len(entry.args) > self._key_index:
+                node = cluster.node_for_key(entry.args[self._key_index])
+            else:
+                node = cluster.nodes[0]
+            groups.setdefault(node.port, []).append(entry)
+
+        results = cluster._fan_out(
+            lambda node: _send(node.client(cluster.client_mode),
+                               groups.get(node.port, [])), None)
+        replies = [None] * len(self.entries)
+        for port, entries in groups.items():
+            node_replies = results[port]
+            if isinstance(node_replies, Exception):
+                raise node_replies
+            for entry, reply in zip(entries, node_replies):
+                replies[entry.index] = reply
+        return replies
+
+    def send(self):
+        if isinstance(self._target, Cluster):
+            self.replies = self._send_cluster(self._target)
+        else:
+            self.replies = _send(self._target, self.entries)
+        return self.replies
+
+    def _mismatch(self, entry, reply):
+        if entry.error:
+            if isinstance(reply, ResponseError):
+                return None
+            return 'Expected redis ResponseError %s, got %r' % (
+                entry.msg or '', reply)
+        if isinstance(reply, ResponseError):
+            return 'Unexpected redis ResponseError: %s' % reply
+        if isinstance(reply, Exception):
+            raise reply
+
+        try:
+            if entry.ok:
+                self._testcase.assertOk(reply, entry.msg)
+            elif entry.expected is not _ANY:
+                self._testcase.assertEqual(entry.expected, reply, entry.msg)
+        except self._testcase.failureException as err:
+            return str(err)
+        return None
+
+    def verify(self):
+        """
+        Send the queued commands and fail with every mismatch
+        """
+        if not self.entries:
+            return
+        replies = self.send()
+        failures = []
+        for entry, reply in zip(self.entries, replies):
+            mismatch = self._mismatch(entry, reply)
+            if mismatch is not None:
+                failures.append('%r: %s' % (entry, mismatch))
+        if failures:
+            self._testcase.fail('%d of %d batched commands failed:\n%s' % (
+                len(failures), len(self.entries), '\n'.join(failures)))
@@ -0,0 +1,233 @@
+# pylint: disable=missing-docstring, invalid-name
+
+"""
+Micro-benchmarks of module commands with baseline regression gating.
+
+A benchmark sends one command many times over a single raw connection,
+pre-packed so that client-side overhead stays out of the measurement, and
+collects one latency sample per round-trip (a pipeline of `pipeline`
+commands). Latency percentiles are computed over all rounds; throughput is the
+median of the per-round rates.
+
+Results are compared against a JSON baseline file stored next to the test
+module (RMTEST_BENCHMARK_BASELINE overrides the path). A metric regresses when
+it is worse than its baseline by more than RMTEST_BENCHMARK_TOLERANCE (0.2 =
+20%). Missing entries are recorded on first run, and all entries are rewritten
+when RMTEST_BENCHMARK_UPDATE is set. The baseline file is read and written
+under a lock file next to it, so parallel test workers do not lose entries.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from rmtest import config
+from rmtest.disposableredis.bulk import checkout_connection
+from rmtest.disposableredis.clientmode import available_modes
+from rmtest.filelock import FileLock
+
+timer = getattr(time, 'perf_counter', time.time)
+
+LATENCY_METRICS = ('p50', 'p95', 'p99', 'max')
+THROUGHPUT_METRICS = ('ops_per_sec',)
+
+
+def percentile(ordered, pct):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not ordered:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+class BenchmarkResult(object):
+    """
+    Latencies are in seconds; `ms()` converts a metric to milliseconds
+    """
+
+    def __init__(self, name, pipeline, samples, round_rates):
+        self.name = name
+        self.pipeline = pipeline
+        self.samples = sorted(samples)
+        self.round_rates = round_rates
+
+    @property
+    def ops(self):
+        return len(self.samples) * self.pipeline
+
+    @property
+    def p50(self):
+        return percentile(self.samples, 50)
+
+    @property
+    def p95(self):
+        return percentile(self.samples, 95)
+
+    @property
+    def p99(self):
+        return percentile(self.samples, 99)
+
+    @property
+    def max(self):
+        return self.samples[-1] if self.samples else 0.0
+
+    @property
+    def mean(self):
+        return sum(self.samples) / len(self.samples) if self.samples else 0.0
+
+    @property
+    def ops_per_sec(self):
+        rates = sorted(self.round_rates)
+        return rates[len(rates) // 2] if rates else 0.0
+
+    def ms(self, metric):
+        return getattr(self, metric) * 1000.0
+
+    def to_dict(self):
+        data = dict((m, getattr(self, m)) for m in LATENCY_METRICS +
+                    THROUGHPUT_METRICS)
+        data['pipeline'] = self.pipeline
+        return data
+
+    def __repr__(self):
+        return '<BenchmarkResult %s: p50=%.3fms p99=%.3fms max=%.3fms ' \
+            '%.0f ops/sec>' % (self.name, self.ms('p50'), self.ms('p99'),
+                               self.ms('max'), self.ops_per_sec)
+
+
+def run_benchmark(client, args, iterations=1000, warmup=100, pipeline=1,
+                  rounds=3, name=None):
+    """
+    Benchmark a single command.
+
+    :param client: redis client whose connection pool is used
+    :param args: command and arguments, e.g. `('mymodule.get', 'key')`
+    :param iterations: round-trips per round
+    :param warmup: round-trips sent before measuring
+    :param pipeline: commands sent per round-trip
+    :param rounds: number of measured rounds
+    :rtype: BenchmarkResult
+    """
+    pool = client.connection_pool
+    conn = checkout_connection(pool)
+    samples = []
+    round_rates = []
+    try:
+        packed = conn.pack_commands([args] * pipeline)
+        send, read = conn.send_packed_command, conn.read_response
+
+        def roundtrip():
+            begin = timer()
+            send(packed)
+            for _ in range(pipeline):
+                read()
+            return timer() - begin
+
+        for _ in range(warmup):
+            roundtrip()
+        for _ in range(rounds):
+            begin = timer()
+            for _ in range(iterations):
+                samples.append(roundtrip())
+            round_rates.append(iterations * pipeline / (timer() - begin))
+    except Exception:
+        conn.disconnect()
+        raise
+    finally:
+        pool.release(conn)
+
+    return BenchmarkResult(name or ' '.join(str(a) for a in args), pipeline,
+                           samples, round_rates)
+
+
+def compare_client_modes(server, args, modes=None, **options):
+    """
+    Benchmark a command once per client mode. The server and the network do
+    the same work in every mode, so the differences between the results are
+    the cost of parsing (and decoding) the reply.
+
+    :param server: the `DisposableRedis` to benchmark against
+    :param modes: client modes to compare, all the available ones by default
+    :return: OrderedDict of mode -> BenchmarkResult
+    """
+    name = options.pop('name', None) or ' '.join(str(a) for a in args)
+    results = OrderedDict()
+    for mode in modes or available_modes():
+        results[mode] = run_benchmark(server.client(mode), args,
+                                      name='%s [%s]' % (name, mode), **options)
+    return results
+
+
+class Baseline(object):
+
+    def __init__(self, path, tolerance=0.2, update=False):
+        self.path = path
+        self.tolerance = tolerance
+        self.update = update
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(path + '.lock')
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, data):
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def check(self, key, result, metrics):
+        """
+        Compare `metrics` of `result` with the baseline entry `key`, recording
+        the result if there is no entry yet (or when updating).
+
+        :return: list of regression messages, empty if none
+        """
+        with self._lock, self._file_lock:
+            data = self._load()
+            entry = data.get(key)
+            if entry is None or self.update:
+                data[key] = result.to_dict()
+                self._save(data)
+                return []
+
+        regressions = []
+        for metric in metrics:
+            base = entry.get(metric)
+            if not base:
+                continue
+            value = getattr(result, metric)
+            if metric in THROUGHPUT_METRICS:
+                worse = value < base * (1 - self.tolerance)
+            else:
+                worse = value > base * (1 + self.tolerance)
+            if worse:
+                regressions.append('%s %s regressed: %.6g vs baseline %.6g '
+                                   '(tolerance %d%%)' % (
+                                       key, metric, value, base,
+                                       self.tolerance * 100))
+        return regressions
+
+
+_baselines = {}
+
+
+def baseline_for(test_file):
+    """
+    :return: the shared `Baseline` for tests defined in `test_file`
+    """
+    path = config.RMTEST_BENCHMARK_BASELINE or os.path.join(
+        os.path.dirname(os.path.abspath(test_file)), 'rmtest-baseline.json')
+    if path not in _baselines:
+        _baselines[path] = Baseline(path, config.RMTEST_BENCHMARK_TOLERANCE,
+                                    config.RMTEST_BENCHMARK_UPDATE)
+    return _baselines[path]
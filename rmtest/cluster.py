@@ -2,48 +2,86 @@
 
 import os
 import contextlib
+import shutil
+import tempfile
 import unittest
 from redis import Redis, ConnectionPool, ResponseError
 from .disposableredis.cluster import Cluster
+from .disposableredis.bulk import bulk_load
+from .disposableredis.load import run_load
+from .batch import Batch
+from .stats import COMMAND_STATS, snapshot, diff, merge
+from . import config
+from .disposableredis.cache import cache_root, args_digest, source_digest, publish_dir
+from .disposableredis.clientmode import resolve as resolve_client_mode, pool_kwargs
 
 REDIS_MODULE_PATH_ENVVAR = 'REDIS_MODULE_PATH'
 REDIS_PATH_ENVVAR = 'REDIS_PATH'
 REDIS_PORT_ENVVAR = 'REDIS_PORT'
+REDIS_CLUSTER_TEMPLATE_ENVVAR = 'REDIS_CLUSTER_TEMPLATE'
 
-def ClusterModuleTestCase(module_path, num_nodes=3, redis_path='redis-server', fixed_port=None, module_args=tuple()):
+def ClusterModuleTestCase(module_path, num_nodes=3, redis_path='redis-server', fixed_port=None, module_args=tuple(),
+                          use_template=False):
     """
     Inherit your test class from the class generated by calling this function
     module_path is where your module.so resides, override it with REDIS_MODULE_PATH in env
     redis_path is the executable's path, override it with REDIS_PATH in env
     redis_port is an optional port for an already running redis
     module_args is an optional tuple or list of arguments to pass to the module on loading
+    use_template starts the cluster from a cached snapshot of the same shape, override it with REDIS_CLUSTER_TEMPLATE in env
     """
 
     module_path = os.getenv(REDIS_MODULE_PATH_ENVVAR, module_path)
     redis_path = os.getenv(REDIS_PATH_ENVVAR, redis_path)
     fixed_port = os.getenv(REDIS_PORT_ENVVAR, fixed_port)
+    if os.getenv(REDIS_CLUSTER_TEMPLATE_ENVVAR) is not None:
+        use_template = config._to_bool(os.getenv(REDIS_CLUSTER_TEMPLATE_ENVVAR))
 
     # If we have module args, create a list of arguments
     loadmodule_args = module_path if not module_args else [module_path] + list(module_args)
 
     class _ModuleTestCase(unittest.TestCase):
 
+        capture_command_stats = config.RMTEST_COMMAND_STATS
+        client_mode = config.REDIS_CLIENT_MODE
 
         @classmethod
         def setUpClass(cls):
             if fixed_port:
                 cls._cluster = None
-                cls._client = Redis(port=fixed_port, connection_pool=ConnectionPool(port=fixed_port))
+                pool = ConnectionPool(port=fixed_port, **pool_kwargs(resolve_client_mode(cls.client_mode)))
+                cls._client = Redis(port=fixed_port, connection_pool=pool)
             else:
-                cls._cluster = Cluster(num_nodes, path=redis_path, loadmodule=loadmodule_args)
+                cls._cluster = Cluster(num_nodes, path=redis_path, template=use_template,
+                                       client_mode=cls.client_mode, loadmodule=loadmodule_args)
                 cls._ports = cls._cluster.start()
-                cls._client = cls._cluster.nodes[0].client()
+                cls._client = cls._cluster.client()
 
         @classmethod
         def tearDownClass(cls):
             if cls._cluster:
                 cls._cluster.stop()
 
+        def setUp(self):
+            super(_ModuleTestCase, self).setUp()
+            self.persistence_cycles = []
+            self._stats_before = None
+            if self.capture_command_stats and self._cluster:
+                self._stats_before = self._cluster._fan_out(
+                    lambda node: snapshot(node.client()), None)
+
+        def tearDown(self):
+            if getattr(self, '_stats_before', None) is not None:
+                after = self._cluster._fan_out(
+                    lambda node: snapshot(node.client()), None)
+                self.command_stats = merge(dict(
+                    (port, diff(self._stats_before[port], after[port]))
+                    for port in after
+                    if not isinstance(after[port], Exception) and
+                    not isinstance(self._stats_before.get(port), Exception)))
+                COMMAND_STATS.add(self.id(), self.command_stats)
+            super(_ModuleTestCase, self).tearDown()
+
 
         def client(self):
             return self._client
@@ -58,8 +96,9 @@ def ClusterModuleTestCase(module_path, num_nodes=3, redis_path='redis-server', f
             """
             Execute a command where the key needs to be known
             """
-            conn = self.client_for_key(key)
-            return conn.execute_command(cmd, key, *args, **kwargs)
+            if not self._cluster:
+                return self._client.execute_command(cmd, key, *args, **kwargs)
+            return self._cluster.key_command(cmd, key, *args, **kwargs)
 
         def cmd(self, *args, **kwargs):
             """
@@ -67,6 +106,24 @@ def ClusterModuleTestCase(module_path, num_nodes=3, redis_path='redis-server', f
             """
             return self._client.execute_command(*args, **kwargs)
 
+        def bulk_load(self, commands, **kwargs):
+            """
+            Stream an iterable of commands into the cluster, grouped by slot and
+            loaded into all nodes concurrently. See
+            `rmtest.disposableredis.bulk.bulk_load` for the options.
+            """
+            return bulk_load(self._cluster or self._client, commands, **kwargs)
+
+        def run_load(self, mix, **options):
+            """
+            Drive all cluster nodes with concurrent clients, routing every
+            command by the slot of its key. See
+            `rmtest.disposableredis.load.run_load` for the options.
+            """
+            if not self._cluster:
+                raise ValueError('Load generation needs a spawned cluster')
+            return run_load(self._cluster, mix, **options)
+
         def assertOk(self, okstr, msg=None):
             if isinstance(okstr, (bytes, bytearray)):
                 self.assertEqual(b"OK", okstr, msg)
@@ -85,18 +142,71 @@ def ClusterModuleTestCase(module_path, num_nodes=3, redis_path='redis-server', f
             self.assertFalse(conn.exists(key), msg)
 
 
-        def retry_with_rdb_reload(self):
+        def load_fixture(self, seed, link='copy'):
+            """
+            Populate the cluster with the dataset created by `seed(self)`.
+
+            The first run saves each node's RDB in the fixture cache, keyed by the
+            source of `seed` and the cluster's shape, binary and module. Later runs
+            restart the nodes directly from those files instead of seeding again.
+            The dataset is shared by all tests of the class.
+            """
+            if not self._cluster:
+                seed(self)
+                return
+
+            cl = self._cluster
+            _, shape, build = cl._template_dir()
+            fixture_dir = cache_root('fixtures', args_digest([source_digest(seed), shape, build]))
+            rdbs = [os.path.join(fixture_dir, 'dump-%d.rdb' % i) for i in range(len(cl.nodes))]
+
+            if all(os.path.exists(rdb) for rdb in rdbs):
+                cl.restart(rdbs=rdbs, link=link)
+                self.__class__._client = cl.client()
+                return
+
+            seed(self)
+            cl.broadcast('SAVE').check()
+            root = os.path.dirname(fixture_dir)
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            tmpdir = tempfile.mkdtemp(dir=root, prefix='.tmp-')
+            for node, rdb in zip(cl.nodes, rdbs):
+                shutil.copy(node.rdb_path, os.path.join(tmpdir, os.path.basename(rdb)))
+            publish_dir(tmpdir, fixture_dir)
+
+        def retry_with_rdb_reload(self, restart=False, strategy='rdb', verify=False):
             """
-            Send DEBUG RELOAD to all nodes and test the result
+            Send DEBUG RELOAD to all nodes and test the result. With `restart`,
+            run a full persistence cycle instead: save (or rewrite the AOF with
+            `strategy='aof'`) on all nodes, restart them in parallel and wait for
+            the cluster to be ok; the per-node timings are kept in
+            `self.persistence_cycles`.
             """
             yield 1
-            if self._cluster:
-                self._cluster.broadcast('DEBUG', 'RELOAD')
+            if self._cluster and restart:
+                self.persistence_cycles.append(
+                    self._cluster.persistence_cycle(strategy, verify).check())
+                self.__class__._client = self._cluster.client()
+            elif self._cluster:
+                self._cluster.broadcast('DEBUG', 'RELOAD').check()
             else:
                 self._client.execute_command('DEBUG', 'RELOAD')
             yield 2
 
 
+        @contextlib.contextmanager
+        def batch(self, key_index=1):
+            """
+            Queue command assertions and check them all at the end of the block.
+            Commands are routed by the slot of the argument at `key_index` and
+            sent in one pipeline per node, to all nodes concurrently. Every
+            mismatch is reported with the index of its command.
+            """
+            batch = Batch(self, self._cluster or self._client, key_index)
+            yield batch
+            batch.verify()
+
         @contextlib.contextmanager
         def assertResponseError(self, msg=None):
             """
@@ -10,6 +10,31 @@ and REDIS_PORT which connects to an already-existent redis server.
 
 The `REDIS_PATH`, `REDIS_MODULE_PATH`, and `REDIS_PORT` environment variables
 can all be used to override these settings.
+
+REDIS_REUSE_SERVER (`reuse_server` in the config file) makes test cases share
+one server per argument signature for the whole session, resetting it between
+tests instead of restarting it.
+
+REDIS_WARM_POOL (`warm_pool`) is the number of already started servers to keep
+ready in the background for tests which need a fresh process.
+
+REDIS_UNIXSOCKET (`unixsocket`) makes spawned servers listen on a unix socket
+and connects the test clients through it instead of TCP.
+
+RMTEST_BENCHMARK_TOLERANCE (`benchmark_tolerance`) is the fraction by which a
+benchmark metric may be worse than its baseline, RMTEST_BENCHMARK_BASELINE
+(`benchmark_baseline`) overrides the baseline file and RMTEST_BENCHMARK_UPDATE
+(`benchmark_update`) rewrites the baseline with the current results.
+
+RMTEST_COMMAND_STATS (`command_stats`) records server-side command statistics
+and slowlog entries for every test and reports the slowest commands at exit.
+
+RMTEST_TRACK_MEMORY (`track_memory`) takes memory readings at the start and
+end of every test and around each reload, warning about growth across reloads.
+
+REDIS_CLIENT_MODE (`client_mode`) is how test clients return replies:
+'decoded' (str, the default), 'raw' (bytes) or 'hiredis' (bytes parsed by
+hiredis, if installed).
 """
 
 import os
@@ -33,7 +58,18 @@ cfg.read(['rmtest.config'])
 entries = {
     'path': ConfigVar('REDIS_PATH', 'executable', 'redis-server'),
     'module': ConfigVar('REDIS_MODULE_PATH', 'module'),
-    'port': ConfigVar('REDIS_PORT', 'existing_port')
+    'port': ConfigVar('REDIS_PORT', 'existing_port'),
+    'reuse': ConfigVar('REDIS_REUSE_SERVER', 'reuse_server'),
+    'warm_pool': ConfigVar('REDIS_WARM_POOL', 'warm_pool', 0),
+    'unixsocket': ConfigVar('REDIS_UNIXSOCKET', 'unixsocket'),
+    'benchmark_tolerance': ConfigVar('RMTEST_BENCHMARK_TOLERANCE',
+                                     'benchmark_tolerance', 0.2),
+    'benchmark_baseline': ConfigVar('RMTEST_BENCHMARK_BASELINE',
+                                    'benchmark_baseline'),
+    'benchmark_update': ConfigVar('RMTEST_BENCHMARK_UPDATE', 'benchmark_update'),
+    'command_stats': ConfigVar('RMTEST_COMMAND_STATS', 'command_stats'),
+    'track_memory': ConfigVar('RMTEST_TRACK_MEMORY', 'track_memory'),
+    'client_mode': ConfigVar('REDIS_CLIENT_MODE', 'client_mode', 'decoded'),
 }
 
 for _, ent in entries.items():
@@ -52,3 +88,20 @@ REDIS_MODULE = entries['module'].value
 REDIS_PORT = entries['port'].value
 if REDIS_PORT:
     REDIS_PORT = int(REDIS_PORT)
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'yes', 'true', 'on')
+    return bool(value)
+
+
+REDIS_REUSE_SERVER = _to_bool(entries['reuse'].value)
+REDIS_WARM_POOL = int(entries['warm_pool'].value or 0)
+REDIS_UNIXSOCKET = _to_bool(entries['unixsocket'].value)
+RMTEST_BENCHMARK_TOLERANCE = float(entries['benchmark_tolerance'].value)
+RMTEST_BENCHMARK_BASELINE = entries['benchmark_baseline'].value
+RMTEST_BENCHMARK_UPDATE = _to_bool(entries['benchmark_update'].value)
+RMTEST_COMMAND_STATS = _to_bool(entries['command_stats'].value)
+RMTEST_TRACK_MEMORY = _to_bool(entries['track_memory'].value)
+REDIS_CLIENT_MODE = entries['client_mode'].value
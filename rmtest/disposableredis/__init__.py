@@ -1,43 +1,82 @@
 # pylint: disable=missing-docstring, invalid-name, broad-except, too-many-instance-attributes
 
 import subprocess
-import socket
-import time
 import os
 import os.path
 import sys
+import tempfile
+import uuid
 import warnings
-import random
 import redis
 
+from rmtest import config
+from .cache import place_file
+from .clientmode import resolve as resolve_client_mode, pool_kwargs
+from .output import OutputCapture
+from .persistence import round_trip
+from .ports import PORTS
+from .readiness import Readiness, wait_for
+from .workdir import make_workdir, remove_workdir
+
 REDIS_DEBUGGER = os.environ.get('REDIS_DEBUGGER', None)
 REDIS_SHOW_OUTPUT = int(os.environ.get(
     'REDIS_VERBOSE', 1 if REDIS_DEBUGGER else 0))
+REDIS_STARTUP_TIMEOUT = float(os.environ.get('REDIS_STARTUP_TIMEOUT', 300))
+REDIS_UNIXSOCKET = config.REDIS_UNIXSOCKET
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 0)) or None
+# unix socket paths are limited to 108 bytes
+_MAX_SOCKET_PATH = 100
 
 
-def get_random_port():
+def get_random_port(bus=False):
+    """
+    Reserve a free port. See `ports.PortAllocator.allocate`
+    """
+    return PORTS.allocate(bus=bus)
 
-    while True:
-        port = random.randrange(1025, 10000)
-        sock = socket.socket()
-        try:
-            sock.listen(port)
-        except Exception:
-            continue
-        #_, port = sock.getsockname()
-        sock.close()
-        return port
+
+class CountingConnectionPool(redis.ConnectionPool):
+    """
+    Connection pool which counts how many connections it opened and how many
+    times an idle connection was handed out again
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.opened = 0
+        self.checkouts = 0
+        super(CountingConnectionPool, self).__init__(*args, **kwargs)
+
+    def make_connection(self):
+        self.opened += 1
+        return super(CountingConnectionPool, self).make_connection()
+
+    def get_connection(self, *args, **kwargs):
+        self.checkouts += 1
+        return super(CountingConnectionPool, self).get_connection(
+            *args, **kwargs)
+
+    @property
+    def reused(self):
+        return self.checkouts - self.opened
 
 
 class Client(redis.StrictRedis):
 
-    def __init__(self, disposable_redis, port):
-        redis.StrictRedis.__init__(self, port=port, decode_responses=True)
+    def __init__(self, disposable_redis, port, connection_pool=None):
+        if connection_pool is not None:
+            redis.StrictRedis.__init__(self, connection_pool=connection_pool)
+        elif disposable_redis.unix_socket_path:
+            redis.StrictRedis.__init__(
+                self, unix_socket_path=disposable_redis.unix_socket_path,
+                **pool_kwargs(disposable_redis.client_mode))
+        else:
+            redis.StrictRedis.__init__(
+                self, port=port, **pool_kwargs(disposable_redis.client_mode))
         self.dr = disposable_redis
 
-    def retry_with_rdb_reload(self):
+    def retry_with_rdb_reload(self, verify=False, strategy=None):
         yield 1
-        self.dr.dump_and_reload()
+        self.dr.dump_and_reload(verify=verify, strategy=strategy)
         yield 2
 
 
@@ -48,6 +87,18 @@ class DisposableRedis(object):
         :param port: port number to start the redis server on.
             Specify none to automatically generate
         :type port: int|None
+        :param startup_timeout: seconds to wait for the server to become
+            ready, REDIS_STARTUP_TIMEOUT by default
+        :param readiness: readiness detection strategy, one of
+            `Readiness.STRATEGIES`
+        :param unixsocket: also listen on a unix socket and connect clients
+            through it. True picks a socket path, a string is used as the
+            path. Defaults to REDIS_UNIXSOCKET
+        :param unixsocket_only: listen on the unix socket only (--port 0)
+        :param max_connections: size limit of the connection pool shared by
+            all clients of this server, REDIS_MAX_CONNECTIONS by default
+        :param client_mode: default mode of `client()`, one of
+            `clientmode.CLIENT_MODES`, REDIS_CLIENT_MODE by default
         :param extra_args: any extra arguments kwargs will
             be passed to redis server as --key val
         """
@@ -58,7 +109,19 @@ class DisposableRedis(object):
         # in that case `port` is randomly generated
         self.port = None
         self._is_external = True if port else False
+        self._init_args = dict(extra_args)
         self.use_aof = extra_args.pop('use_aof', False)
+        self.startup_timeout = extra_args.pop(
+            'startup_timeout', REDIS_STARTUP_TIMEOUT)
+        self.readiness = extra_args.pop('readiness', 'auto')
+        self.unixsocket = extra_args.pop('unixsocket', REDIS_UNIXSOCKET)
+        self.unixsocket_only = extra_args.pop('unixsocket_only', False)
+        self.max_connections = extra_args.pop(
+            'max_connections', REDIS_MAX_CONNECTIONS)
+        self.client_mode = resolve_client_mode(
+            extra_args.pop('client_mode', None))
+        if self.unixsocket_only:
+            self.unixsocket = self.unixsocket or True
         self.args = []
         self.extra_args = []
         for k, v in extra_args.items():
@@ -74,24 +137,147 @@ class DisposableRedis(object):
         self.aoffile = None
         self.pollfile = None
         self.process = None
+        # output.OutputCapture of the running (or last) process
+        self.output = None
+
+        # time to ready of the last start, and of every start so far
+        self.startup_time = None
+        self.startup_times = []
+        self._allocated_port = None
+        self.unix_socket_path = None
+        # working directory created for this instance, see `workdir`
+        self._workdir = None
+
+        # connection pool and client of every client mode in use
+        self._pools = {}
+        self._clients = {}
+        self._connections_opened = 0
+        self._connections_reused = 0
+
+        # memory.MemoryTracker taking readings around dump_and_reload
+        self.memory_tracker = None
+        # persistence.RoundTrip of every timed dump_and_reload
+        self.round_trips = []
 
     def force_start(self):
         self._is_external = False
 
+    def clone(self):
+        """
+        Return a new, not yet started instance with the same arguments
+        """
+        other = type(self)(port=self._port, path=self.path, **self._init_args)
+        other._is_external = self._is_external
+        return other
+
+    @property
+    def signature(self):
+        """
+        Hashable description of the server this instance would launch. Two
+        instances with the same signature are interchangeable once started.
+        """
+        return (self.path, self._port, self.use_aof, bool(self.unixsocket),
+                self.unixsocket_only, tuple(str(arg) for arg in self.extra_args))
+
+    def _arg_value(self, name):
+        flag = '--%s' % name
+        if flag not in self.extra_args:
+            return None
+        idx = self.extra_args.index(flag)
+        if idx + 1 >= len(self.extra_args):
+            return None
+        return str(self.extra_args[idx + 1]) or None
+
+    def _path_arg(self, name):
+        # relative paths are resolved by the server against its --dir
+        value = self._arg_value(name)
+        if value and not os.path.isabs(value) and self.workdir:
+            value = os.path.join(self.workdir, value)
+        return value
+
+    @property
+    def workdir(self):
+        """
+        The server's `--dir`: the `dir` argument if one was given, otherwise
+        a directory of its own (see `workdir.make_workdir`), created on first
+        use and removed when the server is stopped. None for external servers.
+        """
+        given = self._arg_value('dir')
+        if given:
+            return os.path.abspath(given)
+        if self._is_external:
+            return None
+        if self._workdir is None:
+            self._workdir = make_workdir()
+        return self._workdir
+
+    @property
+    def rdb_path(self):
+        """
+        :return: absolute path of the RDB file the server saves to and loads
+        """
+        if not self.dumpfile:
+            return None
+        if self.workdir:
+            return os.path.join(self.workdir, self.dumpfile)
+        return os.path.abspath(self.dumpfile)
+
+    def preload_rdb(self, path, link='copy'):
+        """
+        Make the server load the dataset in `path` when it is next started.
+
+        :param link: 'copy', 'hardlink' or 'symlink' the file into place
+        """
+        if not self.dumpfile:
+            self.dumpfile = 'fixture.%s.rdb' % uuid.uuid4().hex[:12]
+        place_file(path, self.rdb_path, link)
+
+    @property
+    def logfile(self):
+        return self._path_arg('logfile')
+
+    def is_alive(self):
+        """
+        :return: True if the server process is still running and answering
+        """
+        if not self._is_external:
+            if not self.process or self.process.poll() is not None:
+                return False
+        try:
+            return self.client().ping()
+        except redis.RedisError:
+            return False
+
+    def _drained_output(self):
+        if self.output is None:
+            return None
+        if self.process is not None and self.process.poll() is not None:
+            self.output.close()
+        return self.output
+
     def _get_output(self):
-        if not self.process:
-            return ''
-        return '' if REDIS_SHOW_OUTPUT else self.process.stdout.read()
+        output = self._drained_output()
+        return output.text() if output is not None else ''
+
+    def output_tail(self, n=None):
+        """
+        :return: the last `n` lines of server output (REDIS_OUTPUT_TAIL by
+            default), as kept by `output.OutputCapture`
+        """
+        output = self._drained_output()
+        return output.tail(n) if output is not None else ''
+
+    def _command_line(self):
+        if REDIS_DEBUGGER:
+            debugger = REDIS_DEBUGGER.split()
+            return debugger + self.args
+        return self.args
 
     def _start_process(self):
         if self._is_external:
             return
 
-        if REDIS_DEBUGGER:
-            debugger = REDIS_DEBUGGER.split()
-            args = debugger + self.args
-        else:
-            args = self.args
+        args = self._command_line()
         stdout = None if REDIS_SHOW_OUTPUT else subprocess.PIPE
         if REDIS_SHOW_OUTPUT:
             sys.stderr.write("Executing: {}".format(repr(args)))
@@ -101,54 +287,122 @@ class DisposableRedis(object):
             stdout=stdout,
             stderr=sys.stderr,
         )
+        if not REDIS_SHOW_OUTPUT:
+            self.output = OutputCapture(self._output_name())
+            self.output.follow(self.process.stdout)
+
+    def _output_name(self):
+        # ports are reused during a run, the pid keeps spill files apart
+        if self.port:
+            return '%s.%d' % (self.port, self.process.pid)
+        return '%s.%d' % (os.path.basename(self.unix_socket_path or 'redis'),
+                          self.process.pid)
+
+    def wait_ready(self):
+        """
+        Block until a server launched with `start(wait=False)` is ready
+        """
+        if self._is_external:
+            return
 
-        begin = time.time()
-        while True:
-            try:
-                self.client().ping()
-                break
-            except (redis.ConnectionError, redis.ResponseError):
-                self.process.poll()
-                if self.process.returncode is not None:
-                    raise RuntimeError(
-                        "Process has exited with code {}\n. Redis output: {}"
-                        .format(self.process.returncode, self._get_output()))
-
-                if time.time() - begin > 300:
-                    raise RuntimeError(
-                        'Cannot initialize client (waited 5mins)')
-
-                time.sleep(0.1)
+        self.startup_time = Readiness(
+            self, self.readiness, self.startup_timeout).wait()
+        self.startup_times.append(self.startup_time)
 
-    def start(self):
+    def start(self, wait=True):
         """
         Start the server. To stop the server you should call stop()
         accordingly
+
+        :param wait: wait for the server to be ready. If False, call
+            `wait_ready()` before using the server
+        """
+        self._prepare_args()
+        try:
+            self._start_process()
+            if wait:
+                self.wait_ready()
+        except Exception:
+            # release the port and the workdir right away
+            self.stop()
+            raise
+
+    def reserve_port(self):
         """
-        if self._port is None:
-            self.port = get_random_port()
+        Pick the port the server will listen on, without starting it
+        """
+        if self.unixsocket_only:
+            self.port = 0
+        elif self._port is None:
+            if self._allocated_port is None:
+                self._allocated_port = get_random_port(
+                    bus=self._arg_value('cluster-enabled') == 'yes')
+            self.port = self._allocated_port
         else:
             self.port = self._port
+        return self.port
+
+    def _prepare_args(self):
+        self.reserve_port()
 
+        suffix = self.port or uuid.uuid4().hex[:12]
         if not self.dumpfile:
-            self.dumpfile = 'dump.%s.rdb' % self.port
+            self.dumpfile = 'dump.%s.rdb' % suffix
         if not self.aoffile:
-            self.aoffile = 'appendonly.%s.aof' % self.port
+            self.aoffile = 'appendonly.%s.aof' % suffix
+        if self.unixsocket and not self._is_external and \
+                not self.unix_socket_path:
+            if isinstance(self.unixsocket, bool):
+                self.unix_socket_path = os.path.join(
+                    self.workdir, 'redis.%s.sock' % suffix)
+                if len(self.unix_socket_path) > _MAX_SOCKET_PATH:
+                    self.unix_socket_path = os.path.join(
+                        tempfile.gettempdir(), 'redis.%s.sock' % suffix)
+            else:
+                self.unix_socket_path = self.unixsocket
 
         self.args = [self.path,
                      '--port', str(self.port),
                      '--save', '',
                      '--dbfilename', self.dumpfile]
+        if self.workdir and not self._arg_value('dir'):
+            self.args += ['--dir', self.workdir]
+        if self.unix_socket_path:
+            self.args += ['--unixsocket', self.unix_socket_path,
+                          '--unixsocketperm', '700']
         if self.use_aof:
             self.args += ['--appendonly', 'yes',
                           '--appendfilename', self.aoffile]
 
-        self.args += self.extra_args
+        self.args += self._absolute_module_args()
 
-        self._start_process()
+    def _absolute_module_args(self):
+        # redis changes to --dir before loading modules
+        args = list(self.extra_args)
+        for i, arg in enumerate(args[:-1]):
+            if arg == '--loadmodule' and os.sep in str(args[i + 1]):
+                args[i + 1] = os.path.abspath(str(args[i + 1]))
+        return args
+
+    def _release_resources(self):
+        self._cleanup_files()
+        if self._allocated_port is not None:
+            PORTS.release(self._allocated_port)
+            self._allocated_port = None
 
     def _cleanup_files(self):
-        for f in (self.aoffile, self.dumpfile):
+        if self._workdir is not None:
+            remove_workdir(self._workdir)
+            self._workdir = None
+            files = (self.unix_socket_path,)
+        else:
+            base = self._arg_value('dir') or ''
+            files = (self.aoffile and os.path.join(base, self.aoffile),
+                     self.dumpfile and os.path.join(base, self.dumpfile),
+                     self.unix_socket_path)
+        for f in files:
+            if not f:
+                continue
             try:
                 os.unlink(f)
             except OSError:
@@ -158,10 +412,14 @@ class DisposableRedis(object):
         if self._is_external:
             return
 
-        self.process.terminate()
-        self.process.wait()
+        self._close_pool()
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        if self.output is not None:
+            self.output.close()
         if not for_restart:
-            self._cleanup_files()
+            self._release_resources()
 
     def __enter__(self):
         self.start()
@@ -170,25 +428,43 @@ class DisposableRedis(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop()
         if exc_val or self.errored:
-            sys.stderr.write("Redis output: {}\n".format(self._get_output()))
+            sys.stderr.write("Redis output: {}\n".format(self.output_tail()))
 
     def _wait_for_child(self):
         # Wait until file is available
         r = self.client()
-        while True:
+
+        def rewrite_done():
             info = r.info('persistence')
-            if info['aof_rewrite_scheduled'] or info['aof_rewrite_in_progress']:
-                time.sleep(0.1)
-            else:
-                break
+            return not (info['aof_rewrite_scheduled'] or
+                        info['aof_rewrite_in_progress'])
 
-    def dump_and_reload(self, restart_process=False):
+        wait_for(rewrite_done, self.startup_timeout, what='AOF rewrite')
+
+    def dump_and_reload(self, restart_process=False, verify=False,
+                        strategy=None):
         """
         Dump the rdb and reload it, to test for serialization errors
+
+        :param verify: compare `DEBUG DIGEST` before and after the round-trip
+            and raise `persistence.DigestMismatch` if the dataset changed
+        :param strategy: 'rdb', 'aof' or 'dump' (see `persistence`); given
+            either this or `verify`, the round-trip is timed and returned as a
+            `persistence.RoundTrip`, also kept in `round_trips`
         """
         conn = self.client()
+        result = None
+        if self.memory_tracker is not None:
+            self.memory_tracker.before_reload()
 
-        if restart_process:
+        if verify or strategy:
+            if restart_process and self._is_external:
+                warnings.warn('Tied to an external process. Cannot restart')
+                return None
+            result = round_trip(self, strategy or 'rdb', restart_process,
+                                verify)
+            self.round_trips.append(result)
+        elif restart_process:
             if self._is_external:
                 warnings.warn('Tied to an external process. Cannot restart')
                 return
@@ -205,8 +481,49 @@ class DisposableRedis(object):
                 self.errored = True
                 raise err
 
-    def client(self):
+        if self.memory_tracker is not None:
+            self.memory_tracker.after_reload()
+        return result
+
+    def _close_pool(self):
+        for pool in self._pools.values():
+            self._connections_opened += pool.opened
+            self._connections_reused += pool.reused
+            pool.disconnect()
+        self._pools = {}
+        self._clients = {}
+
+    def connection_stats(self):
+        """
+        :return: number of connections opened and reused over the lifetime of
+            this instance
+        """
+        opened, reused = self._connections_opened, self._connections_reused
+        for pool in self._pools.values():
+            opened += pool.opened
+            reused += pool.reused
+        return {'opened': opened, 'reused': reused}
+
+    def client(self, mode=None):
         """
+        Return the client of this server. All clients of a mode share one
+        connection pool, which is closed when the server is stopped.
+
+        :param mode: client mode (see `clientmode`), `client_mode` by default
         :rtype: redis.StrictRedis
         """
-        return Client(self, self.port)
+        mode = mode or self.client_mode
+        if mode not in self._clients:
+            kwargs = pool_kwargs(resolve_client_mode(mode))
+            if self.unix_socket_path:
+                pool = CountingConnectionPool(
+                    connection_class=redis.UnixDomainSocketConnection,
+                    path=self.unix_socket_path,
+                    max_connections=self.max_connections, **kwargs)
+            else:
+                pool = CountingConnectionPool(
+                    port=self.port, max_connections=self.max_connections,
+                    **kwargs)
+            self._pools[mode] = pool
+            self._clients[mode] = Client(self, self.port, connection_pool=pool)
+        return self._clients[mode]
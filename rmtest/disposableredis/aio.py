@@ -0,0 +1,455 @@
+# pylint: disable=missing-docstring, invalid-name, broad-except, invalid-overridden-method, protected-access
+
+"""
+asyncio counterparts of `DisposableRedis` and `Cluster`.
+
+Processes are started with `asyncio.create_subprocess_exec` and readiness is
+awaited without blocking the event loop, so a single process can drive a
+large number of concurrent connections through `aclient()`.
+
+Requires Python 3 and a redis-py version providing `redis.asyncio`.
+
+The lifecycle methods of the synchronous classes become coroutines here
+(`start`, `stop`, `restart`, `broadcast`, ...). `AsyncCluster` wraps a
+`Cluster` of `AsyncDisposableRedis` nodes for its topology and slot logic and
+exposes only coroutines for anything that talks to the nodes.
+"""
+
+import asyncio
+import functools
+import logging as log
+import os
+import sys
+import time
+import warnings
+from collections import OrderedDict
+
+import redis
+import redis.asyncio as aioredis
+
+from . import DisposableRedis, REDIS_SHOW_OUTPUT
+from .clientmode import pool_kwargs
+from .cluster import Cluster, ClusterStartupError, BroadcastResult, \
+    BroadcastTimeout
+from .output import OutputCapture
+from .persistence import round_trip
+from .readiness import Readiness, ReadinessTimeout
+
+
+async def async_wait_for(predicate, timeout, check=None, initial=0.00005,
+                         maximum=0.1, what='condition'):
+    """
+    Coroutine version of `readiness.wait_for`: `predicate` and `check` are
+    coroutine functions
+    """
+    begin = time.time()
+    delay = initial
+    while True:
+        result = await predicate()
+        if result:
+            return result
+        if check:
+            await check()
+        if time.time() - begin > timeout:
+            raise ReadinessTimeout(
+                "%s not reached after %s seconds" % (what, timeout))
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, maximum)
+
+
+class AsyncDisposableRedis(DisposableRedis):
+    """
+    `DisposableRedis` whose lifecycle methods are coroutines. `client()` still
+    returns a synchronous client; use `aclient()` from async code.
+    """
+
+    def __init__(self, port=None, path='redis-server', **extra_args):
+        super(AsyncDisposableRedis, self).__init__(port, path, **extra_args)
+        self._apool = None
+        self._output_task = None
+
+    async def start(self, wait=True):
+        self._prepare_args()
+        if self._is_external:
+            return
+        try:
+            await self._start_process_async(wait)
+        except Exception:
+            await self.stop()
+            raise
+
+    async def _start_process_async(self, wait):
+        args = [str(arg) for arg in self._command_line()]
+        if REDIS_SHOW_OUTPUT:
+            sys.stderr.write("Executing: {}".format(repr(args)))
+        self.process = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=None if REDIS_SHOW_OUTPUT else asyncio.subprocess.PIPE,
+            stderr=sys.stderr)
+        if not REDIS_SHOW_OUTPUT:
+            self.output = OutputCapture(self._output_name())
+            self._output_task = asyncio.ensure_future(
+                self._pump_output(self.process.stdout))
+        if wait:
+            await self.wait_ready()
+
+    async def wait_ready(self):
+        """
+        Wait for the server with its `readiness` strategy, in the default
+        executor so that the event loop keeps draining the server output
+        """
+        if self._is_external:
+            return
+
+        loop = asyncio.get_running_loop()
+        self.startup_time = await loop.run_in_executor(
+            None, Readiness(self, self.readiness, self.startup_timeout).wait)
+        self.startup_times.append(self.startup_time)
+
+    def is_alive(self):
+        if not self._is_external:
+            if not self.process or self.process.returncode is not None:
+                return False
+        try:
+            return self.client().ping()
+        except redis.RedisError:
+            return False
+
+    async def _pump_output(self, stream):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            self.output.feed(line)
+        self.output.end()
+
+    def _drained_output(self):
+        # drained by _pump_output on the event loop, see _aoutput_tail
+        return self.output
+
+    async def _drain_output(self):
+        if self._output_task is not None:
+            await self._output_task
+            self._output_task = None
+        if self.output is not None:
+            self.output.close()
+
+    async def _aoutput_tail(self):
+        if self.process is not None and self.process.returncode is not None:
+            await self._drain_output()
+        return self.output_tail()
+
+    async def _close_apool(self):
+        if self._apool is not None:
+            await self._apool.disconnect()
+            self._apool = None
+
+    async def stop(self, for_restart=False):
+        if self._is_external:
+            return
+
+        self._close_pool()
+        await self._close_apool()
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+        await self._drain_output()
+        if not for_restart:
+            self._release_resources()
+
+    async def __aenter__(self):
+        await self.start()
+        return self.aclient()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+        if exc_val or self.errored:
+            sys.stderr.write("Redis output: {}\n".format(self.output_tail()))
+
+    async def dump_and_reload(self, restart_process=False, verify=False,
+                              strategy=None):
+        """
+        Coroutine version of `DisposableRedis.dump_and_reload`
+        """
+        conn = self.aclient()
+
+        if verify or strategy:
+            if restart_process and self._is_external:
+                warnings.warn('Tied to an external process. Cannot restart')
+                return None
+            # the round-trip blocks, so it runs in the default executor and
+            # hands the process restart back to the event loop
+            loop = asyncio.get_running_loop()
+
+            def restart(_):
+                asyncio.run_coroutine_threadsafe(
+                    self._restart(), loop).result()
+
+            result = await loop.run_in_executor(None, functools.partial(
+                round_trip, self, strategy or 'rdb', restart_process, verify,
+                restart_with=restart))
+            self.round_trips.append(result)
+            return result
+        if restart_process:
+            await conn.bgrewriteaof()
+
+            async def rewrite_done():
+                info = await conn.info('persistence')
+                return not (info['aof_rewrite_scheduled'] or
+                            info['aof_rewrite_in_progress'])
+
+            await async_wait_for(rewrite_done, self.startup_timeout,
+                                 what='AOF rewrite')
+            await self._restart()
+        else:
+            await conn.save()
+            try:
+                await conn.execute_command('DEBUG', 'RELOAD')
+            except redis.RedisError as err:
+                self.errored = True
+                raise err
+        return None
+
+    async def _restart(self):
+        await self.stop(for_restart=True)
+        await self.start()
+
+    def aclient(self):
+        """
+        Return an asyncio client. All async clients of this server share one
+        connection pool, bound to the running event loop.
+
+        :rtype: redis.asyncio.Redis
+        """
+        if self._apool is None:
+            kwargs = pool_kwargs(self.client_mode, asyncio=True)
+            if self.unix_socket_path:
+                self._apool = aioredis.ConnectionPool(
+                    connection_class=aioredis.UnixDomainSocketConnection,
+                    path=self.unix_socket_path,
+                    max_connections=self.max_connections, **kwargs)
+            else:
+                self._apool = aioredis.ConnectionPool(
+                    port=self.port, max_connections=self.max_connections,
+                    **kwargs)
+        return aioredis.Redis(connection_pool=self._apool)
+
+
+class AsyncCluster(object):
+    """
+    Cluster of `AsyncDisposableRedis` nodes. Nodes are started and stopped
+    concurrently on the event loop; the topology bootstrap, templates and
+    other blocking work of the wrapped `Cluster` run in the default executor.
+    """
+
+    def __init__(self, num_nodes=3, path='redis-server', template=False,
+                 **extra_args):
+        """
+        Takes the arguments of `Cluster`
+        """
+        self.cluster = Cluster(num_nodes, path, template, **extra_args)
+        self.cluster.node_class = AsyncDisposableRedis
+
+    @property
+    def nodes(self):
+        return self.cluster.nodes
+
+    @property
+    def ports(self):
+        return self.cluster.ports
+
+    @property
+    def from_template(self):
+        return self.cluster.from_template
+
+    @property
+    def startup_times(self):
+        return self.cluster.startup_times
+
+    @property
+    def bootstrap_times(self):
+        return self.cluster.bootstrap_times
+
+    @property
+    def persistence_times(self):
+        return self.cluster.persistence_times
+
+    def node_for_key(self, key):
+        return self.cluster.node_for_key(key)
+
+    def aclient_for_key(self, key):
+        """
+        :return: an async client of the node serving `key`
+        """
+        return self.node_for_key(key).aclient()
+
+    async def _blocking(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(func, *args, **kwargs))
+
+    async def _launch_all(self):
+        nodes = self.cluster.nodes
+        results = await asyncio.gather(
+            *(node.start() for node in nodes), return_exceptions=True)
+        self.cluster.startup_times = [node.startup_time for node in nodes]
+        errors = dict((i, res) for i, res in enumerate(results)
+                      if isinstance(res, Exception))
+        if errors:
+            await self.stop()
+            raise ClusterStartupError(nodes, errors)
+
+    async def _start_from_template(self):
+        """
+        Coroutine version of `Cluster._start_from_template`
+        """
+        cl = self.cluster
+        found = await self._blocking(cl._find_template)
+        if found is None:
+            return False
+        tpl, meta = found
+
+        begin = time.time()
+        try:
+            ports = await self._blocking(cl._prepare_from_template, tpl, meta)
+            await self._launch_all()
+            cl.ports = ports
+            cl.bootstrap_times = OrderedDict(
+                [('template', time.time() - begin)])
+            await self._blocking(cl._wait_cluster, 10)
+            await self._blocking(cl.refresh_slots)
+        except Exception as err:
+            log.warning("Could not start cluster from template %s: %s",
+                        tpl, err)
+            await self.stop()
+            cl._forget_nodes()
+            return False
+
+        cl.from_template = True
+        return True
+
+    async def start(self):
+        cl = self.cluster
+        if cl.use_template and await self._start_from_template():
+            return cl.ports
+
+        cl._create_nodes()
+        await self._launch_all()
+        cl.ports = [node.port for node in cl.nodes]
+
+        await self._blocking(cl._setup_cluster)
+        await self._blocking(cl._wait_cluster, 10)
+        await self._blocking(cl.refresh_slots)
+
+        if cl.use_template:
+            try:
+                await self.save_template()
+            except Exception as err:
+                log.warning("Could not save cluster template: %s", err)
+
+        return cl.ports
+
+    async def save_template(self, include_data=False):
+        """
+        Coroutine version of `Cluster.save_template`
+        """
+        await self._blocking(self.cluster.save_template, include_data)
+
+    async def restart(self, rdbs=None, link='copy'):
+        """
+        Coroutine version of `Cluster.restart`
+        """
+        results = await asyncio.gather(
+            *(node.stop(for_restart=True) for node in self.cluster.nodes),
+            return_exceptions=True)
+        BroadcastResult(zip(self.cluster.ports, results)).check()
+        if rdbs:
+            for node, rdb in zip(self.cluster.nodes, rdbs):
+                node.preload_rdb(rdb, link)
+        await self._launch_all()
+
+        await self._blocking(self.cluster._wait_cluster, 10)
+        await self._blocking(self.cluster.refresh_slots)
+
+    async def persistence_cycle(self, strategy='rdb', verify=False):
+        """
+        Coroutine version of `Cluster.persistence_cycle`
+        """
+        cl = self.cluster
+        trips = await self._blocking(cl._save_for_cycle, strategy, verify)
+
+        begin = time.time()
+        await self.restart()
+        cl.persistence_times['restart'] = time.time() - begin
+
+        return await self._blocking(cl._check_cycle, trips, verify)
+
+    async def _fan_out(self, func, timeout):
+        """
+        Await `func(node)` on all nodes concurrently and collect the results
+        """
+
+        async def run(node):
+            try:
+                return await asyncio.wait_for(func(node), timeout)
+            except asyncio.TimeoutError:
+                return BroadcastTimeout(
+                    "No reply from node %s within %s seconds"
+                    % (node.port, timeout))
+
+        nodes = self.cluster.nodes
+        results = await asyncio.gather(
+            *(run(node) for node in nodes), return_exceptions=True)
+        return BroadcastResult(
+            (node.port, res) for node, res in zip(nodes, results))
+
+    async def broadcast(self, *args, **kwargs):
+        """
+        Execute a command on all nodes concurrently.
+
+        :param timeout: seconds to wait for each node to reply
+        :return: `BroadcastResult` mapping each node's port to its reply, or
+            to the exception raised on that node
+        """
+        timeout = kwargs.pop('timeout', None)
+        return await self._fan_out(
+            lambda node: node.aclient().execute_command(*args, **kwargs),
+            timeout)
+
+    async def broadcast_pipeline(self, commands, timeout=None):
+        """
+        Coroutine version of `Cluster.broadcast_pipeline`
+        """
+
+        async def run(node):
+            pipe = node.aclient().pipeline(transaction=False)
+            for command in commands:
+                pipe.execute_command(*command)
+            return await pipe.execute(raise_on_error=False)
+
+        return await self._fan_out(run, timeout)
+
+    async def key_command(self, cmd, key, *args, **kwargs):
+        """
+        Coroutine version of `Cluster.key_command`, run in the default
+        executor so that redirections share its slot table handling
+        """
+        return await self._blocking(
+            self.cluster.key_command, cmd, key, *args, **kwargs)
+
+    async def stop(self):
+        cl = self.cluster
+        if cl._pool is not None:
+            cl._pool.shutdown(wait=False)
+            cl._pool = None
+
+        results = await asyncio.gather(
+            *(node.stop() for node in cl.nodes), return_exceptions=True)
+        for err in results:
+            if isinstance(err, Exception):
+                log.error("Error stopping node: %s", err)
+        for conf in cl.confs:
+            try:
+                os.unlink(conf)
+            except OSError:
+                pass
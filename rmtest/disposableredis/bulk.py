@@ -0,0 +1,203 @@
+# pylint: disable=missing-docstring, invalid-name, broad-except
+
+"""
+Bulk loading of generated datasets.
+
+Commands are consumed lazily from any iterable and sent in batches, either as
+non-transactional pipelines or as raw RESP buffers written in one go, so even
+very large datasets never need to be materialized in memory. In cluster mode
+commands are grouped by the hash slot of their key and every node is loaded
+concurrently from a bounded queue.
+"""
+
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # pragma: no cover - Python 2
+    import Queue as queue
+
+import redis
+
+from . import DisposableRedis
+from .cluster import Cluster
+
+MODES = ('pipeline', 'resp')
+
+
+class BulkLoadError(RuntimeError):
+
+    def __init__(self, result):
+        self.result = result
+        batch, count, first = result.errors[0]
+        super(BulkLoadError, self).__init__(
+            "%d commands failed, first in batch %d (%d errors): %s"
+            % (result.failed, batch, count, first))
+
+
+class BulkLoadResult(object):
+
+    def __init__(self):
+        self.commands = 0
+        self.batches = 0
+        # (batch number, number of failed commands, first error) per batch
+        self.errors = []
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def failed(self):
+        return sum(count for _, count, _ in self.errors)
+
+    @property
+    def keys_per_sec(self):
+        """
+        Commands (usually one per key) loaded per second
+        """
+        return self.commands / self.elapsed if self.elapsed else 0.0
+
+    def _add_batch(self, size, failures):
+        with self._lock:
+            batch = self.batches
+            self.batches += 1
+            self.commands += size
+            if failures:
+                self.errors.append((batch, len(failures), failures[0]))
+
+    def __repr__(self):
+        return '<BulkLoadResult %d commands in %.2fs (%.0f/s), %d failed>' % (
+            self.commands, self.elapsed, self.keys_per_sec, self.failed)
+
+
+def _send_pipeline(client, batch):
+    pipe = client.pipeline(transaction=False)
+    for command in batch:
+        pipe.execute_command(*command)
+    return [r for r in pipe.execute(raise_on_error=False)
+            if isinstance(r, Exception)]
+
+
+def checkout_connection(pool):
+    """
+    Take a connection out of a redis-py connection pool, for any version
+    """
+    try:
+        return pool.get_connection()
+    except TypeError:
+        # redis-py < 5.3 requires a command name
+        return pool.get_connection('BULK')
+
+
+def _send_resp(client, batch):
+    pool = client.connection_pool
+    conn = checkout_connection(pool)
+    failures = []
+    try:
+        conn.send_packed_command(conn.pack_commands(batch))
+        for _ in batch:
+            try:
+                conn.read_response()
+            except redis.ResponseError as err:
+                failures.append(err)
+    except Exception:
+        conn.disconnect()
+        raise
+    finally:
+        pool.release(conn)
+    return failures
+
+
+def _batches(commands, batch_size):
+    batch = []
+    for command in commands:
+        batch.append(command)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _load_single(client, commands, batch_size, send, result):
+    for batch in _batches(commands, batch_size):
+        result._add_batch(len(batch), send(client, batch))
+
+
+def _load_cluster(cluster, commands, batch_size, send, result, key_index,
+                  max_pending):
+    queues = {}
+    buffers = {}
+    threads = []
+
+    def worker(node, q):
+        client = node.client()
+        while True:
+            batch = q.get()
+            if batch is None:
+                return
+            try:
+                result._add_batch(len(batch), send(client, batch))
+            except Exception as err:
+                result._add_batch(len(batch), [err] * len(batch))
+
+    for node in cluster.nodes:
+        queues[node.port] = queue.Queue(maxsize=max_pending)
+        buffers[node.port] = []
+        thread = threading.Thread(target=worker, args=(node, queues[node.port]))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for command in commands:
+            port = cluster.node_for_key(command[key_index]).port
+            buf = buffers[port]
+            buf.append(command)
+            if len(buf) >= batch_size:
+                queues[port].put(buf)
+                buffers[port] = []
+    finally:
+        for port, q in queues.items():
+            if buffers[port]:
+                q.put(buffers[port])
+            q.put(None)
+        for thread in threads:
+            thread.join()
+
+
+def bulk_load(target, commands, batch_size=1000, mode='pipeline', key_index=1,
+              max_pending=4, raise_on_error=False):
+    """
+    Stream commands into a server or cluster in large batches.
+
+    :param target: a `Cluster`, a `DisposableRedis` or a redis client
+    :param commands: iterable (typically a generator) of command argument
+        tuples, e.g. `('SET', 'key:1', 'value')`
+    :param batch_size: number of commands sent per round-trip
+    :param mode: 'pipeline' or 'resp' (raw RESP mass-insert buffers)
+    :param key_index: position of the key in each command, used to route
+        commands to cluster nodes
+    :param max_pending: batches queued per cluster node before the producer
+        blocks, bounding memory use
+    :param raise_on_error: raise `BulkLoadError` at the end if any command
+        failed, instead of only reporting the errors in the result
+    :rtype: BulkLoadResult
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown bulk load mode %r" % mode)
+    send = _send_pipeline if mode == 'pipeline' else _send_resp
+    result = BulkLoadResult()
+
+    begin = time.time()
+    if isinstance(target, Cluster):
+        _load_cluster(target, commands, batch_size, send, result, key_index,
+                      max_pending)
+    else:
+        client = target.client() if isinstance(target, DisposableRedis) else target
+        _load_single(client, commands, batch_size, send, result)
+    result.elapsed = time.time() - begin
+
+    if raise_on_error and result.errors:
+        raise BulkLoadError(result)
+    return result
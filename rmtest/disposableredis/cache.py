@@ -0,0 +1,128 @@
+# pylint: disable=missing-docstring, invalid-name
+
+"""
+On-disk cache shared by cluster templates and dataset fixtures.
+
+The cache lives under RMTEST_CACHE_DIR (~/.cache/rmtest by default). Entries
+are keyed by content hashes of the redis binary and the loaded module, so a
+rebuilt module never picks up stale entries.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+
+try:
+    from shutil import which
+except ImportError:  # pragma: no cover - Python 2
+    from distutils.spawn import find_executable as which
+
+_digests = {}
+
+
+def cache_root(*parts):
+    root = os.environ.get('RMTEST_CACHE_DIR') or \
+        os.path.join(os.path.expanduser('~'), '.cache', 'rmtest')
+    return os.path.join(root, *parts)
+
+
+def file_digest(path):
+    """
+    :return: sha1 of the file contents, cached by path, size and mtime
+    """
+    if os.sep not in path:
+        path = which(path) or path
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 'missing:%s' % path
+    key = (os.path.realpath(path), st.st_size, st.st_mtime)
+    if key not in _digests:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                sha.update(chunk)
+        _digests[key] = sha.hexdigest()
+    return _digests[key]
+
+
+def build_digest(path, loadmodule):
+    """
+    :return: digest of a redis binary and the module (with its arguments)
+        loaded into it
+    """
+    if loadmodule and not isinstance(loadmodule, (list, tuple)):
+        loadmodule = [loadmodule]
+    loadmodule = [str(arg) for arg in (loadmodule or [])]
+    parts = [file_digest(path)]
+    if loadmodule:
+        parts += [file_digest(loadmodule[0])] + loadmodule[1:]
+    return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def args_digest(args):
+    """
+    :return: digest of a JSON-serializable description of server arguments
+    """
+    data = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def source_digest(func):
+    """
+    :return: digest of a function's source code (or its qualified name if
+        the source is unavailable)
+    """
+    try:
+        source = inspect.getsource(func)
+    except (IOError, OSError, TypeError):
+        source = '%s.%s' % (getattr(func, '__module__', ''),
+                            getattr(func, '__qualname__', repr(func)))
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def place_file(src, dst, link='copy'):
+    """
+    Put a cached file at `dst` by copying, hardlinking or symlinking it.
+    Redis replaces its RDB by renaming a new file over it, so the cached file
+    is never modified through a link.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if link == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass  # e.g. across filesystems
+    elif link == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return
+    elif link != 'copy':
+        raise ValueError("Unknown link mode %r" % link)
+    shutil.copyfile(src, dst)
+
+
+def publish_file(src, final):
+    """
+    Atomically copy `src` into the cache as `final`
+    """
+    dirname = os.path.dirname(final)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp = '%s.%d.tmp' % (final, os.getpid())
+    shutil.copyfile(src, tmp)
+    os.rename(tmp, final)
+
+
+def publish_dir(tmpdir, final):
+    """
+    Move a fully written `tmpdir` into place as `final`, unless another
+    process got there first
+    """
+    try:
+        os.rename(tmpdir, final)
+    except OSError:
+        shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,61 @@
+# pylint: disable=missing-docstring, invalid-name
+
+"""
+Client modes, i.e. how the replies of a server are parsed and returned.
+
+- `decoded`: replies are decoded to str (the default)
+- `raw`: replies are returned as bytes, so binary payloads survive and no
+  time is spent decoding them
+- `hiredis`: bytes, parsed by the hiredis C parser. When hiredis is not
+  installed this falls back to `raw`, with a warning.
+
+redis-py already uses hiredis for `decoded` and `raw` when it is installed;
+the `hiredis` mode makes that choice explicit and independent of the
+environment. REDIS_CLIENT_MODE (see `rmtest.config`) sets the default mode of
+every server.
+"""
+
+import warnings
+
+from redis.utils import HIREDIS_AVAILABLE
+
+from rmtest import config
+
+try:
+    from redis._parsers import _HiredisParser as HiredisParser
+    from redis._parsers import _AsyncHiredisParser as AsyncHiredisParser
+except ImportError:  # redis-py < 5
+    from redis.connection import HiredisParser
+    AsyncHiredisParser = None
+
+CLIENT_MODES = ('decoded', 'raw', 'hiredis')
+
+
+def resolve(mode):
+    """
+    :return: `mode`, or the mode it falls back to in this environment
+    """
+    mode = mode or config.REDIS_CLIENT_MODE
+    if mode not in CLIENT_MODES:
+        raise ValueError("Unknown client mode %r, expected one of %s" % (
+            mode, ', '.join(CLIENT_MODES)))
+    if mode == 'hiredis' and not HIREDIS_AVAILABLE:
+        warnings.warn('hiredis is not installed, using the raw client mode')
+        return 'raw'
+    return mode
+
+
+def available_modes():
+    return tuple(m for m in CLIENT_MODES if m != 'hiredis' or HIREDIS_AVAILABLE)
+
+
+def pool_kwargs(mode, asyncio=False):
+    """
+    :return: connection pool arguments for the (resolved) client `mode`
+    """
+    kwargs = {'decode_responses': mode == 'decoded'}
+    if mode == 'hiredis':
+        parser = AsyncHiredisParser if asyncio else HiredisParser
+        if parser is not None:
+            kwargs['parser_class'] = parser
+    return kwargs
@@ -1,83 +1,205 @@
 # pylint: disable=missing-docstring, invalid-name, broad-except
 
 import os
+import re
+import json
+import shutil
+import tempfile
 import time
 import uuid
+from collections import OrderedDict
 import logging as log
+from concurrent.futures import ThreadPoolExecutor, as_completed, \
+    TimeoutError as FutureTimeoutError
+from redis import ResponseError
 from . import DisposableRedis
+from .readiness import wait_for, ReadinessTimeout
+from .slots import NUM_SLOTS, key_slot, parse_redirect
+from .cache import cache_root, build_digest, args_digest, publish_dir
+from .clientmode import resolve as resolve_client_mode
+from .persistence import RoundTrip, DigestMismatch, dataset_digest
+
+MAX_REDIRECTS = 5
+_ADDR_RE = re.compile(r'([0-9a-fA-F.:]*?):(\d+)@(\d+)')
+
+
+class ClusterStartupError(RuntimeError):
+
+    def __init__(self, nodes, errors):
+        self.errors = errors
+        lines = ["%d of %d cluster nodes failed to start" % (len(errors), len(nodes))]
+        for i in sorted(errors):
+            lines.append("node %d (port %s): %s" % (i, nodes[i].port, errors[i]))
+        super(ClusterStartupError, self).__init__("\n".join(lines))
+
+
+class BroadcastTimeout(Exception):
+    pass
+
+
+class BroadcastError(RuntimeError):
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(BroadcastError, self).__init__("\n".join(
+            "node %s: %s" % (port, err) for port, err in errors.items()))
+
+
+class BroadcastResult(OrderedDict):
+    """
+    Node port -> reply (or exception) of a broadcast, in node order
+    """
+
+    @property
+    def errors(self):
+        return OrderedDict((port, res) for port, res in self.items()
+                           if isinstance(res, Exception))
+
+    def check(self):
+        """
+        Raise `BroadcastError` if any node failed, else return self
+        """
+        if self.errors:
+            raise BroadcastError(self.errors)
+        return self
+
 
 class Cluster(object):
 
-    def __init__(self, num_nodes=3, path='redis-server', **extra_args):
+    node_class = DisposableRedis
+
+    def __init__(self, num_nodes=3, path='redis-server', template=False, **extra_args):
+        """
+        :param template: start from a cached snapshot of a converged cluster
+            of the same shape if there is one, and save one otherwise
+        :param client_mode: mode of the clients returned by `client()` and
+            `client_for_key()` (see `clientmode`); the cluster itself talks
+            to its nodes with decoded clients
+        :param extra_args: passed to every node's `DisposableRedis`, e.g.
+            `unixsocket=True` to talk to the nodes over unix sockets
+        """
 
         self.common_conf = {
             'cluster-enabled': 'yes',
             'cluster-node-timeout': '5000',
         }
+        self.client_mode = resolve_client_mode(extra_args.pop('client_mode', None))
         self.common_conf.update(extra_args)
+        self.common_conf['client_mode'] = 'decoded'
         self.num_nodes = num_nodes
         self.nodes = []
         self.ports = []
         self.confs = []
         self.redis_path = path
         self.extra_args = extra_args
+        self.use_template = template
+        # True if the last start() was served from a template
+        self.from_template = False
+
+        # time to ready of each node in the last start, in seconds
+        self.startup_times = []
+        # seconds spent in each phase of the last topology bootstrap
+        self.bootstrap_times = OrderedDict()
+        # seconds spent saving and restarting in the last persistence_cycle
+        self.persistence_times = OrderedDict()
+        self._slot_table = None
+        self._pool = None
+
+    def refresh_slots(self):
+        """
+        Rebuild the slot -> node table from CLUSTER SLOTS
+        """
+
+        by_port = dict((node.port, i) for i, node in enumerate(self.nodes))
+        table = [None] * NUM_SLOTS
+        reply = self.nodes[0].client().execute_command('CLUSTER SLOTS')
+        for entry in reply:
+            first, last, master = entry[0], entry[1], entry[2]
+            table[int(first):int(last) + 1] = \
+                [by_port[int(master[1])]] * (int(last) - int(first) + 1)
+        self._slot_table = table
 
     def _node_by_slot(self, slot):
 
-        slots_per_node = int(16384 / len(self.ports)) + 1
-        for i, node in enumerate(self.nodes):
+        if self._slot_table is None:
+            self.refresh_slots()
+        index = self._slot_table[slot]
+        return self.nodes[index] if index is not None else None
 
-            start_slot = i * slots_per_node
-            end_slot = start_slot + slots_per_node - 1
-            if end_slot > 16383:
-                end_slot = 16383
-            if start_slot <= slot <= end_slot:
-                return node
+    def _slot_ranges(self):
+        """
+        :return: the (first, last) slot served by each node
+        """
+        n = len(self.nodes)
+        return [(i * NUM_SLOTS // n, (i + 1) * NUM_SLOTS // n - 1) for i in range(n)]
 
-        return None
+    @staticmethod
+    def _supports_addslotsrange(conn):
+        version = conn.info('server')['redis_version']
+        return tuple(int(x) for x in version.split('.')[:2]) >= (7, 0)
 
     def _setup_cluster(self):
-
-        for i, node in enumerate(self.nodes):
-            conn = node.client()
-            conn.cluster('RESET')
-
-        slots_per_node = int(16384 / len(self.ports)) + 1
-        for i, node in enumerate(self.nodes):
-            assert isinstance(node, DisposableRedis)
-            conn = node.client()
-            for port in self.ports:
-                conn.cluster('MEET', '127.0.0.1', port)
-
-            start_slot = i * slots_per_node
-            end_slot = start_slot + slots_per_node
-            if end_slot > 16384:
-                end_slot = 16384
-
-            conn.cluster('ADDSLOTS', *(str(x) for x in range(start_slot, end_slot)))
-
+        """
+        Assign slots and join all nodes through a single seed node, with one
+        pipelined round-trip per node and phase. The time spent in each phase
+        is recorded in `bootstrap_times`.
+        """
+
+        clients = [node.client() for node in self.nodes]
+        use_range = self._supports_addslotsrange(clients[0])
+
+        begin = time.time()
+        for conn, (first, last) in zip(clients, self._slot_ranges()):
+            pipe = conn.pipeline(transaction=False)
+            pipe.execute_command('CLUSTER RESET')
+            if use_range:
+                pipe.execute_command('CLUSTER ADDSLOTSRANGE', first, last)
+            else:
+                pipe.execute_command('CLUSTER ADDSLOTS', *range(first, last + 1))
+            pipe.execute()
+        self.bootstrap_times['slots'] = time.time() - begin
+
+        begin = time.time()
+        pipe = clients[0].pipeline(transaction=False)
+        for port in self.ports[1:]:
+            pipe.execute_command('CLUSTER MEET', '127.0.0.1', port)
+        pipe.execute()
+        self.bootstrap_times['meet'] = time.time() - begin
+
+    @staticmethod
+    def _config_epochs(conn):
+        """
+        :return: {node id: config epoch} as seen by the node behind `conn`
+        """
+        reply = conn.execute_command('CLUSTER NODES')
+        if isinstance(reply, dict):
+            return dict((v['node_id'], v['epoch']) for v in reply.values())
+        return dict((line.split()[0], line.split()[6])
+                    for line in reply.splitlines() if line.strip())
+
+    def _converged(self):
+        views = []
+        for conn in (node.client() for node in self.nodes):
+            info = conn.cluster('INFO')
+            if info.get('cluster_state') != 'ok' or \
+                    int(info.get('cluster_known_nodes', 0)) != len(self.nodes) or \
+                    int(info.get('cluster_slots_ok', 0)) != NUM_SLOTS:
+                return False
+            views.append(self._config_epochs(conn))
+        return all(view == views[0] for view in views)
 
     def _wait_cluster(self, timeout_sec):
 
-        st = time.time()
-        ok = 0
+        begin = time.time()
+        try:
+            wait_for(self._converged, timeout_sec)
+        except ReadinessTimeout:
+            raise RuntimeError("Cluster OK wait loop timed out after %s seconds" % timeout_sec)
+        self.bootstrap_times['converge'] = time.time() - begin
+        log.info("All nodes OK! Cluster bootstrap times: %s",
+                 self.bootstrap_times)
 
-        while st + timeout_sec > time.time():
-            ok = 0
-            for node in self.nodes:
-                status = node.client().cluster('INFO')
-                if status.get('cluster_state') == 'ok':
-                    ok += 1
-            if ok == len(self.nodes):
-                print("All nodes OK!")
-                return
-
-            time.sleep(0.1)
-        raise RuntimeError("Cluster OK wait loop timed out after %s seconds" % timeout_sec)
-
-
-
-    def _start_nodes(self):
+    def _create_nodes(self):
 
         # Assign a random "session id"
         uid = uuid.uuid4().hex
@@ -86,40 +208,370 @@ class Cluster(object):
             conf = self.common_conf.copy()
             nodeconf = 'node-%s.%d.conf' % (uid, i)
             conf['cluster-config-file'] = nodeconf
-            self.confs.append(nodeconf)
-
 
-            node = DisposableRedis(path=self.redis_path, **conf)
+            node = self.node_class(path=self.redis_path, **conf)
             node.force_start()
-            node.start()
-
             self.nodes.append(node)
-            self.ports.append(node.port)
+            # the server resolves its cluster-config-file against its --dir
+            self.confs.append(os.path.join(node.workdir, nodeconf))
+
+    def _start_nodes(self):
+
+        self._create_nodes()
+        self._launch_nodes()
+        self.ports = [node.port for node in self.nodes]
+
+
+    def _launch_nodes(self):
+        """
+        Fork all node processes first, then wait for all of them to become
+        ready concurrently. On failure every node is stopped and the errors
+        of all failing nodes are raised together.
+        """
+
+        errors = {}
+        for i, node in enumerate(self.nodes):
+            try:
+                node.start(wait=False)
+            except Exception as err:
+                errors[i] = err
+
+        waiting = [i for i in range(len(self.nodes)) if i not in errors]
+        if waiting:
+            with ThreadPoolExecutor(max_workers=len(waiting)) as pool:
+                futures = dict((pool.submit(self.nodes[i].wait_ready), i)
+                               for i in waiting)
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as err:
+                        errors[futures[future]] = err
+
+        self.startup_times = [node.startup_time for node in self.nodes]
+
+        if errors:
+            self.stop()
+            raise ClusterStartupError(self.nodes, errors)
 
 
     def start(self):
 
+        if self.use_template and self._start_from_template():
+            return self.ports
+
         self._start_nodes()
         self._setup_cluster()
 
         self._wait_cluster(10)
+        self.refresh_slots()
+
+        if self.use_template:
+            try:
+                self.save_template()
+            except Exception as err:
+                log.warning("Could not save cluster template: %s", err)
 
         return self.ports
 
+    def restart(self, rdbs=None, link='copy'):
+        """
+        Restart all node processes on their ports and with their cluster
+        config files, then wait for the cluster to be ok again.
 
-    def broadcast(self, *args):
+        :param rdbs: optional list with an RDB file for each node to load
+        :param link: how to put the RDB files in place, see `preload_rdb`
+        """
 
-        rs = []
+        self._fan_out(lambda node: node.stop(for_restart=True), None).check()
+        if rdbs:
+            for node, rdb in zip(self.nodes, rdbs):
+                node.preload_rdb(rdb, link)
+        self._launch_nodes()
+        self._wait_cluster(10)
+        self.refresh_slots()
+
+    def _persist(self, node, strategy):
+        """
+        Start a background save or AOF rewrite on `node` and wait for it on
+        the node's cached client.
+
+        :return: seconds until the child process finished
+        """
+
+        client = node.client()
+        begin = time.time()
+        if strategy == 'rdb':
+            client.bgsave()
+            fields = ('rdb_bgsave_in_progress',)
+            status = 'rdb_last_bgsave_status'
+        else:
+            client.bgrewriteaof()
+            fields = ('aof_rewrite_in_progress', 'aof_rewrite_scheduled')
+            status = 'aof_last_bgrewrite_status'
+
+        def done():
+            info = client.info('persistence')
+            return not any(info[field] for field in fields) and info
+
+        info = wait_for(done, node.startup_timeout,
+                        what='%s persistence on node %s' % (strategy, node.port))
+        if info[status] != 'ok':
+            raise RuntimeError('%s failed on node %s: %s' % (
+                strategy, node.port, info[status]))
+        return time.time() - begin
+
+    def persistence_cycle(self, strategy='rdb', verify=False):
+        """
+        Persist every node concurrently (BGSAVE, or BGREWRITEAOF with
+        `strategy='aof'`), restart all node processes in parallel on their
+        ports and cluster config files, and wait for the cluster to be ok.
+
+        :param verify: compare each node's `DEBUG DIGEST` before and after
+        :return: `BroadcastResult` mapping each node's port to its
+            `persistence.RoundTrip` (save and load times), or to the error of
+            that node, e.g. a `persistence.DigestMismatch`
+        """
+
+        trips = self._save_for_cycle(strategy, verify)
+
+        begin = time.time()
+        self.restart()
+        self.persistence_times['restart'] = time.time() - begin
+
+        return self._check_cycle(trips, verify)
+
+    def _save_for_cycle(self, strategy, verify):
+        """
+        First half of `persistence_cycle`: persist every node concurrently
+
+        :return: the `RoundTrip` of each node port, with the save times
+        """
+
+        if strategy not in ('rdb', 'aof'):
+            raise ValueError("Unknown persistence strategy %r" % strategy)
+        if (strategy == 'aof') != bool(self.common_conf.get('use_aof')):
+            # nodes load their AOF on startup if and only if use_aof is set
+            raise ValueError("The %s strategy needs a cluster started with "
+                             "use_aof=%s" % (strategy, strategy == 'aof'))
+
+        trips = OrderedDict()
         for node in self.nodes:
+            trips[node.port] = RoundTrip(strategy, restart=True)
+        self.persistence_times = OrderedDict()
+
+        def before(node):
+            client = node.client()
+            trips[node.port].keys = client.dbsize()
+            if verify:
+                trips[node.port].digest_before = dataset_digest(client)
+            trips[node.port].save_time = self._persist(node, strategy)
+
+        begin = time.time()
+        self._fan_out(before, None).check()
+        self.persistence_times['save'] = time.time() - begin
+        return trips
+
+    def _check_cycle(self, trips, verify):
+        """
+        Second half of `persistence_cycle`, once the nodes were restarted
+        """
+
+        def after(node):
+            trip = trips[node.port]
+            trip.load_time = node.startup_time
+            if verify:
+                trip.digest_after = dataset_digest(node.client())
+                if trip.digest_after != trip.digest_before:
+                    raise DigestMismatch(trip)
+            return trip
+
+        return self._fan_out(after, None)
+
+    def _conf_path(self, i):
+        return self.confs[i]
+
+    def _template_dir(self):
+        conf = dict((k, v) for k, v in self.common_conf.items()
+                    if k not in ('loadmodule', 'unixsocket', 'client_mode'))
+        shape = '%s-%d' % (args_digest(conf)[:12], self.num_nodes)
+        build = build_digest(self.redis_path, self.common_conf.get('loadmodule'))
+        return cache_root('cluster-templates'), shape, build
+
+    def save_template(self, include_data=False):
+        """
+        Save the current topology (node configs and, optionally, each node's
+        RDB) so that later clusters of the same shape can start from it. Any
+        template of the same shape built from a different binary or module
+        is removed.
+        """
+
+        root, shape, build = self._template_dir()
+        final = os.path.join(root, '%s-%s' % (shape, build[:16]))
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        tmpdir = tempfile.mkdtemp(dir=root, prefix='.tmp-')
+
+        self.broadcast('CLUSTER', 'SAVECONFIG').check()
+        if include_data:
+            self.broadcast('SAVE').check()
+        for i, node in enumerate(self.nodes):
+            shutil.copy(self._conf_path(i), os.path.join(tmpdir, 'node-%d.conf' % i))
+            if include_data:
+                shutil.copy(node.rdb_path, os.path.join(tmpdir, 'dump-%d.rdb' % i))
+        with open(os.path.join(tmpdir, 'meta.json'), 'w') as fp:
+            json.dump({'ports': self.ports, 'build': build,
+                       'data': include_data}, fp)
+
+        for name in os.listdir(root):
+            if name.startswith(shape + '-') and name != os.path.basename(final):
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        if os.path.isdir(final):
+            shutil.rmtree(final, ignore_errors=True)
+        publish_dir(tmpdir, final)
+
+    @staticmethod
+    def _rewrite_ports(conf, port_map):
+        def replace(match):
+            port = port_map.get(int(match.group(2)), int(match.group(2)))
+            return '%s:%d@%d' % (match.group(1), port, port + 10000)
+        return _ADDR_RE.sub(replace, conf)
+
+    def _find_template(self):
+        """
+        :return: the directory and metadata of a usable saved template, or
+            None if there is none
+        """
+
+        root, shape, build = self._template_dir()
+        tpl = os.path.join(root, '%s-%s' % (shape, build[:16]))
+        try:
+            with open(os.path.join(tpl, 'meta.json')) as fp:
+                meta = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+        if meta.get('build') != build or len(meta['ports']) != self.num_nodes:
+            return None
+        return tpl, meta
+
+    def _prepare_from_template(self, tpl, meta):
+        """
+        Create the nodes on fresh ports, with copies of the template's node
+        configs (and RDB files) rewritten for those ports
+
+        :return: the node ports
+        """
+
+        self._create_nodes()
+        ports = [node.reserve_port() for node in self.nodes]
+        port_map = dict(zip(meta['ports'], ports))
+        for i, node in enumerate(self.nodes):
+            with open(os.path.join(tpl, 'node-%d.conf' % i)) as fp:
+                conf = self._rewrite_ports(fp.read(), port_map)
+            with open(self._conf_path(i), 'w') as fp:
+                fp.write(conf)
+            if meta.get('data'):
+                node.dumpfile = 'dump.%s.rdb' % node.port
+                shutil.copy(os.path.join(tpl, 'dump-%d.rdb' % i), node.rdb_path)
+        return ports
+
+    def _forget_nodes(self):
+        self.nodes, self.ports, self.confs = [], [], []
+        self._slot_table = None
+
+    def _start_from_template(self):
+        """
+        Start the nodes directly from copies of a saved template, on fresh
+        ports and without any bootstrap handshake.
+
+        :return: False if there is no usable template
+        """
+
+        found = self._find_template()
+        if found is None:
+            return False
+        tpl, meta = found
+
+        begin = time.time()
+        try:
+            ports = self._prepare_from_template(tpl, meta)
+            self._launch_nodes()
+            self.ports = ports
+            self.bootstrap_times = OrderedDict([('template', time.time() - begin)])
+            self._wait_cluster(10)
+            self.refresh_slots()
+        except Exception as err:
+            log.warning("Could not start cluster from template %s: %s", tpl, err)
+            self.stop()
+            self._forget_nodes()
+            return False
+
+        self.from_template = True
+        return True
+
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=max(1, len(self.nodes)))
+        return self._pool
+
+    def _fan_out(self, func, timeout):
+        """
+        Run `func(node)` on all nodes concurrently and collect the results
+        """
+
+        futures = [(node.port, self._executor().submit(func, node))
+                   for node in self.nodes]
+        deadline = time.time() + timeout if timeout is not None else None
+        results = BroadcastResult()
+        for port, future in futures:
+            try:
+                remaining = None if deadline is None else max(0, deadline - time.time())
+                results[port] = future.result(remaining)
+            except FutureTimeoutError:
+                results[port] = BroadcastTimeout(
+                    "No reply from node %s within %s seconds" % (port, timeout))
+            except Exception as err:
+                results[port] = err
+        return results
+
+    def broadcast(self, *args, **kwargs):
+        """
+        Execute a command on all nodes concurrently.
+
+        :param timeout: seconds to wait for the nodes to reply
+        :return: `BroadcastResult` mapping each node's port to its reply, or
+            to the exception raised on that node
+        """
+
+        timeout = kwargs.pop('timeout', None)
+        return self._fan_out(
+            lambda node: node.client().execute_command(*args, **kwargs),
+            timeout)
+
+    def broadcast_pipeline(self, commands, timeout=None):
+        """
+        Send several commands to every node in a single pipelined round-trip.
 
-            conn = node.client()
-            rs.append(conn.execute_command(*args))
+        :param commands: sequence of command argument tuples
+        :return: `BroadcastResult` mapping each node's port to the list of its
+            replies. Failed commands appear as exceptions in that list.
+        """
 
-        return rs
+        def run(node):
+            pipe = node.client().pipeline(transaction=False)
+            for command in commands:
+                pipe.execute_command(*command)
+            return pipe.execute(raise_on_error=False)
+
+        return self._fan_out(run, timeout)
 
 
     def stop(self):
 
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
         for i, node in enumerate(self.nodes):
             assert isinstance(node, DisposableRedis)
             try:
@@ -131,10 +583,51 @@ class Cluster(object):
             except OSError:
                 pass
 
+    def node_for_key(self, key):
+        """
+        :return: the node serving `key`, computed locally from the slot table
+        """
+
+        return self._node_by_slot(key_slot(key))
+
+    def client(self):
+        """
+        :return: a client of the first node, in `client_mode`
+        """
+
+        return self.nodes[0].client(self.client_mode)
+
     def client_for_key(self, key):
 
-        conn = self.nodes[0].client()
-        slot = conn.cluster('KEYSLOT', key)
-        node = self._node_by_slot(slot)
+        node = self.node_for_key(key)
+        return node.client(self.client_mode)
 
-        return node.client()
+    def key_command(self, cmd, key, *args, **kwargs):
+        """
+        Execute a command on the node serving `key`, following MOVED (after
+        refreshing the slot table) and ASK redirections.
+        """
+
+        conn = self.client_for_key(key)
+        asking = False
+        for _ in range(MAX_REDIRECTS):
+            try:
+                if asking:
+                    pipe = conn.pipeline(transaction=False)
+                    pipe.execute_command('ASKING')
+                    pipe.execute_command(cmd, key, *args, **kwargs)
+                    return pipe.execute()[1]
+                return conn.execute_command(cmd, key, *args, **kwargs)
+            except ResponseError as err:
+                redirect = parse_redirect(err)
+                if redirect is None:
+                    raise
+                kind, _, port = redirect
+                if kind == 'MOVED':
+                    self.refresh_slots()
+                    conn = self.client_for_key(key)
+                    asking = False
+                else:
+                    conn = self.nodes[self.ports.index(port)].client(self.client_mode)
+                    asking = True
+        raise RuntimeError("Too many redirections for key %r" % (key,))
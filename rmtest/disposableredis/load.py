@@ -0,0 +1,349 @@
+# pylint: disable=missing-docstring, invalid-name, broad-except, too-many-arguments
+
+"""
+Concurrent load generation against a `DisposableRedis` or a `Cluster`.
+
+Clients are spread over a pool of worker processes (each running its share of
+clients as threads), so the load is not limited by the GIL of a single Python
+process. Every client sends a weighted mix of commands over its own raw
+connections; keys are drawn from a uniform, zipfian or sequential distribution
+and, against a cluster, each command goes straight to the node owning its slot.
+Latency histograms of all clients are merged into one `LoadResult`.
+"""
+
+import bisect
+import math
+import multiprocessing
+import random
+import threading
+import time
+import traceback
+
+import redis
+
+from .cluster import Cluster
+from .slots import key_slot
+
+timer = getattr(time, 'perf_counter', time.time)
+
+DISTRIBUTIONS = ('uniform', 'zipfian', 'sequential')
+KEY_PLACEHOLDER = '{key}'
+
+
+class LoadGeneratorError(RuntimeError):
+    pass
+
+
+class Histogram(object):
+    """
+    Latency histogram in microseconds, with buckets of two significant digits
+    (so percentiles are accurate to within 10%). Histograms are plain dicts
+    underneath and can be merged across processes.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})
+
+    @staticmethod
+    def _bucket(usec):
+        usec = int(usec)
+        if usec < 100:
+            return usec
+        scale = 10 ** (len(str(usec)) - 2)
+        return usec // scale * scale
+
+    def record(self, seconds):
+        bucket = self._bucket(seconds * 1e6)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            bucket = int(bucket)
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        return self
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def percentile(self, pct):
+        """
+        :return: latency in microseconds below which `pct` percent of the
+            samples fall
+        """
+        total = self.total
+        if not total:
+            return 0
+        rank = max(1, int(math.ceil(pct / 100.0 * total)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return bucket
+        return max(self.counts)
+
+    def summary(self):
+        return dict(('p%s' % p, self.percentile(p)) for p in (50, 90, 99, 99.9))
+
+
+class LoadResult(object):
+
+    def __init__(self):
+        self.ops = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self.histogram = Histogram()
+        # per command name, and per node port in cluster mode
+        self.commands = {}
+        self.nodes = {}
+        self.first_errors = []
+
+    @property
+    def ops_per_sec(self):
+        return self.ops / self.elapsed if self.elapsed else 0.0
+
+    def _merge(self, stats):
+        self.ops += stats['ops']
+        self.errors += stats['errors']
+        self.elapsed = max(self.elapsed, stats['elapsed'])
+        self.histogram.merge(Histogram(stats['histogram']))
+        for name, counts in stats['commands'].items():
+            self.commands.setdefault(name, Histogram()).merge(Histogram(counts))
+        for port, ops in stats['nodes'].items():
+            self.nodes[port] = self.nodes.get(port, 0) + ops
+        self.first_errors += stats['first_errors'][:10 - len(self.first_errors)]
+
+    def __repr__(self):
+        summary = self.histogram.summary()
+        return '<LoadResult %d ops in %.2fs (%.0f ops/sec), %d errors, ' \
+            'p50=%dus p99=%dus>' % (self.ops, self.elapsed, self.ops_per_sec,
+                                     self.errors, summary['p50'],
+                                     summary['p99'])
+
+
+class KeyChooser(object):
+
+    """
+    Draws key numbers in `range(keyspace)`. Sequential choosers with
+    `offset=i, stride=n` for i in range(n) together cover every key once per
+    pass.
+    """
+
+    def __init__(self, distribution, keyspace, skew=0.99, offset=0, stride=1,
+                 seed=None):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError("Unknown key distribution %r" % distribution)
+        self.distribution = distribution
+        self.keyspace = keyspace
+        self._next = offset
+        self._stride = stride
+        self._random = random.Random(seed)
+        if distribution == 'zipfian':
+            self._cdf = _zipf_cdf(keyspace, skew)
+
+    def __call__(self):
+        if self.distribution == 'uniform':
+            return self._random.randrange(self.keyspace)
+        if self.distribution == 'sequential':
+            key = self._next % self.keyspace
+            self._next += self._stride
+            return key
+        point = self._random.random() * self._cdf[-1]
+        return min(bisect.bisect_right(self._cdf, point), self.keyspace - 1)
+
+
+_zipf_cdfs = {}
+_zipf_lock = threading.Lock()
+
+
+def _zipf_cdf(keyspace, skew):
+    # shared by all clients of a process
+    with _zipf_lock:
+        if (keyspace, skew) not in _zipf_cdfs:
+            _zipf_cdfs[keyspace, skew] = _cumulative(
+                1.0 / (rank ** skew) for rank in range(1, keyspace + 1))
+        return _zipf_cdfs[keyspace, skew]
+
+
+def _cumulative(weights):
+    total = 0.0
+    cdf = []
+    for weight in weights:
+        total += weight
+        cdf.append(total)
+    return cdf
+
+
+def _endpoints(target):
+    """
+    :return: picklable connection parameters of every node, and the slot
+        table (None for a single server)
+    """
+    if isinstance(target, Cluster):
+        if target._slot_table is None:
+            target.refresh_slots()
+        nodes = [_endpoint(node) for node in target.nodes]
+        return nodes, list(target._slot_table)
+    return [_endpoint(target)], None
+
+
+def _endpoint(server):
+    if server.unix_socket_path:
+        return {'path': server.unix_socket_path, 'port': server.port}
+    return {'port': server.port}
+
+
+def _connect(endpoint):
+    if 'path' in endpoint:
+        conn = redis.UnixDomainSocketConnection(path=endpoint['path'])
+    else:
+        conn = redis.Connection(port=endpoint['port'])
+    conn.connect()
+    return conn
+
+
+def _client_loop(spec, client_id):
+    conns = [_connect(ep) for ep in spec['endpoints']]
+    rnd = random.Random('%s:%d:mix' % (spec['seed'], client_id))
+    choose_key = KeyChooser(spec['distribution'], spec['keyspace'],
+                            spec['skew'], offset=client_id,
+                            stride=spec['clients'],
+                            seed='%s:%d:keys' % (spec['seed'], client_id))
+    mix, cdf = spec['mix'], _cumulative(w for w, _ in spec['mix'])
+    slots = spec['slots']
+
+    histogram = Histogram()
+    commands = {}
+    nodes = {}
+    ops = errors = 0
+    first_errors = []
+    quota = None
+    if spec['ops']:
+        quota = spec['ops'] // spec['clients'] + \
+            (1 if client_id < spec['ops'] % spec['clients'] else 0)
+
+    try:
+        while time.time() < spec['start_at']:
+            time.sleep(0.001)
+        started = time.time()
+        deadline = started + spec['duration'] if spec['duration'] else None
+        while True:
+            if quota is not None and ops >= quota:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+
+            args = mix[bisect.bisect_right(cdf, rnd.random() * cdf[-1])][1]
+            key = spec['key_format'] % choose_key()
+            args = [key if a == KEY_PLACEHOLDER else a for a in args]
+            index = slots[key_slot(key)] if slots else 0
+
+            begin = timer()
+            try:
+                conns[index].send_command(*args)
+                conns[index].read_response()
+            except redis.ResponseError as err:
+                errors += 1
+                if len(first_errors) < 10:
+                    first_errors.append('%s: %s' % (args[0], err))
+            latency = timer() - begin
+
+            ops += 1
+            histogram.record(latency)
+            name = args[0]
+            if name not in commands:
+                commands[name] = Histogram()
+            commands[name].record(latency)
+            if slots:
+                port = spec['endpoints'][index]['port']
+                nodes[port] = nodes.get(port, 0) + 1
+    finally:
+        for conn in conns:
+            conn.disconnect()
+
+    return {'ops': ops, 'errors': errors, 'elapsed': time.time() - started,
+            'histogram': histogram.counts,
+            'commands': dict((n, h.counts) for n, h in commands.items()),
+            'nodes': nodes, 'first_errors': first_errors}
+
+
+def _run_client(spec, client_id, stats, lock):
+    try:
+        result = _client_loop(spec, client_id)
+    except Exception:
+        result = {'crashed': 'client %d: %s' % (client_id,
+                                                 traceback.format_exc())}
+    with lock:
+        stats.append(result)
+
+
+def _run_worker(args):
+    spec, client_ids = args
+    stats = []
+    lock = threading.Lock()
+    threads = [threading.Thread(target=_run_client,
+                                args=(spec, cid, stats, lock))
+               for cid in client_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats
+
+
+def run_load(target, mix, clients=8, processes=None, duration=None, ops=None,
+             keyspace=10000, distribution='uniform', skew=0.99,
+             key_format='key:%d', seed=0):
+    """
+    Run concurrent clients against a server or cluster.
+
+    :param target: a `DisposableRedis` or a `Cluster`
+    :param mix: list of `(weight, args)` pairs, e.g.
+        `[(9, ('mymodule.get', '{key}')), (1, ('mymodule.add', '{key}', 1))]`;
+        the `'{key}'` argument is replaced by a key from the distribution
+    :param clients: number of concurrent clients (connections per node)
+    :param processes: worker processes to spread the clients over (default
+        one per CPU, at most one per client)
+    :param duration: seconds to run for
+    :param ops: total number of commands to send (when no duration is given)
+    :param keyspace: number of distinct keys
+    :param distribution: 'uniform', 'zipfian' or 'sequential'
+    :param skew: zipfian exponent
+    :rtype: LoadResult
+    """
+    if not duration and not ops:
+        raise ValueError("Either duration or ops is required")
+    if not mix:
+        raise ValueError("Empty command mix")
+
+    endpoints, slots = _endpoints(target)
+    processes = min(clients, processes or multiprocessing.cpu_count())
+    spec = {
+        'endpoints': endpoints, 'slots': slots,
+        'mix': [(float(w), tuple(args)) for w, args in mix],
+        'distribution': distribution, 'keyspace': keyspace, 'skew': skew,
+        'key_format': key_format, 'seed': seed, 'duration': duration,
+        'ops': None if duration else ops, 'clients': clients,
+        # give every process time to start, so all clients begin together
+        'start_at': time.time() + 0.2 + 0.02 * processes,
+    }
+    shares = [(spec, list(range(i, clients, processes)))
+              for i in range(processes)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        outputs = pool.map(_run_worker, shares)
+    finally:
+        pool.close()
+        pool.join()
+
+    stats = [client for worker in outputs for client in worker]
+    crashed = [client['crashed'] for client in stats if 'crashed' in client]
+    if crashed:
+        raise LoadGeneratorError('%d of %d clients failed, first: %s' % (
+            len(crashed), clients, crashed[0]))
+
+    result = LoadResult()
+    for client_stats in stats:
+        result._merge(client_stats)
+    return result
@@ -0,0 +1,125 @@
+# pylint: disable=missing-docstring, invalid-name
+
+"""
+Memory readings of a server, taken at labelled points of a test.
+
+A reading holds the `INFO memory` figures that matter for leak hunting
+(used_memory, the dataset part of it, RSS and fragmentation), the number of
+keys, and the `MEMORY USAGE` of a fixed sample of keys, chosen the first time
+the keyspace is not empty so that later readings measure the same keys.
+"""
+
+import warnings
+
+import redis
+
+MEMORY_FIELDS = ('used_memory', 'used_memory_dataset', 'used_memory_rss',
+                 'mem_fragmentation_ratio', 'allocator_frag_ratio')
+
+
+class MemoryLeakWarning(UserWarning):
+    pass
+
+
+def memory_reading(client, keys=()):
+    """
+    :return: dict of the `MEMORY_FIELDS` present in `INFO memory`, `keys`
+        (the number of keys) and `key_usage` (key -> bytes for `keys`)
+    """
+    info = client.info('memory')
+    reading = dict((field, info[field]) for field in MEMORY_FIELDS
+                   if field in info)
+    reading['keys'] = client.dbsize()
+    reading['key_usage'] = dict((key, client.memory_usage(key))
+                                for key in keys)
+    return reading
+
+
+def sample_keys(client, count):
+    keys = []
+    for key in client.scan_iter(count=max(count, 10)):
+        keys.append(key)
+        if len(keys) >= count:
+            break
+    return keys
+
+
+def bytes_per_key(reading):
+    """
+    :return: dataset memory divided by the number of keys, or None if empty
+    """
+    if not reading['keys']:
+        return None
+    used = reading.get('used_memory_dataset', reading['used_memory'])
+    return float(used) / reading['keys']
+
+
+def is_monotonic_growth(values, min_growth=0):
+    """
+    :return: True if every value is larger than the one before it and the
+        total growth exceeds `min_growth`
+    """
+    if len(values) < 2:
+        return False
+    steps = [b - a for a, b in zip(values, values[1:])]
+    return all(step > 0 for step in steps) and values[-1] - values[0] > min_growth
+
+
+class MemoryTracker(object):
+    """
+    Records labelled memory readings of one server. `DisposableRedis` takes a
+    reading before and after every `dump_and_reload` when a tracker is
+    attached to it.
+    """
+
+    def __init__(self, client_factory, samples=10, min_growth=1 << 16):
+        self._client_factory = client_factory
+        self.samples = samples
+        self.min_growth = min_growth
+        self.readings = []
+        self._keys = None
+        self._reloads = 0
+
+    def record(self, label):
+        client = self._client_factory()
+        if self._keys is None and self.samples and client.dbsize():
+            self._keys = sample_keys(client, self.samples)
+        reading = memory_reading(client, self._keys or ())
+        self.readings.append((label, reading))
+        return reading
+
+    def before_reload(self):
+        self._reloads += 1
+        return self.record('before reload %d' % self._reloads)
+
+    def after_reload(self):
+        return self.record('after reload %d' % self._reloads)
+
+    def values(self, prefix, metric='used_memory'):
+        return [reading[metric] for label, reading in self.readings
+                if label.startswith(prefix) and metric in reading]
+
+    def reload_growth(self, metric='used_memory'):
+        """
+        :return: True if `metric` grew after every reload, by more than
+            `min_growth` in total (at least three reloads are needed)
+        """
+        values = self.values('after reload', metric)
+        return len(values) >= 3 and is_monotonic_growth(values, self.min_growth)
+
+    def check(self):
+        """
+        Warn about monotonic growth across reloads
+        """
+        if self.reload_growth():
+            values = self.values('after reload')
+            warnings.warn(MemoryLeakWarning(
+                'used_memory grew after each of %d reloads: %s' % (
+                    len(values), ', '.join(str(v) for v in values))))
+
+
+def safe_record(tracker, label):
+    try:
+        return tracker.record(label)
+    except (redis.RedisError, OSError):
+        return None
@@ -0,0 +1,122 @@
+# pylint: disable=missing-docstring, invalid-name
+
+"""
+Capture of server output.
+
+A server's stdout is drained continuously by a background thread as it is
+written, so a chatty server never blocks on a full pipe. The most recent
+REDIS_OUTPUT_LINES lines (1000 by default) are kept in memory; set
+REDIS_OUTPUT_SPILL_DIR to also write every line to a log file per server
+process in that directory. Failures report only the last REDIS_OUTPUT_TAIL
+lines (50 by default).
+"""
+
+import collections
+import os
+import threading
+
+from .readiness import READY_MARKER
+
+REDIS_OUTPUT_LINES = int(os.environ.get('REDIS_OUTPUT_LINES', 1000))
+REDIS_OUTPUT_TAIL = int(os.environ.get('REDIS_OUTPUT_TAIL', 50))
+REDIS_OUTPUT_SPILL_DIR = os.environ.get('REDIS_OUTPUT_SPILL_DIR')
+
+
+class OutputCapture(object):
+
+    def __init__(self, name, max_lines=None, spill_dir=None):
+        """
+        :param name: instance name, used for the spill file
+        :param max_lines: lines kept in memory, REDIS_OUTPUT_LINES by default
+        :param spill_dir: directory of the spill file, REDIS_OUTPUT_SPILL_DIR
+            by default (no spill file if unset)
+        """
+        self._lines = collections.deque(
+            maxlen=max_lines or REDIS_OUTPUT_LINES)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.dropped = 0
+        # set once the server logged that it accepts connections, or once
+        # its output ended; `marker_seen` tells which
+        self.ready = threading.Event()
+        self.marker_seen = False
+
+        spill_dir = spill_dir or REDIS_OUTPUT_SPILL_DIR
+        self.spill_path = None
+        self._spill = None
+        if spill_dir:
+            if not os.path.isdir(spill_dir):
+                os.makedirs(spill_dir)
+            self.spill_path = os.path.join(spill_dir, 'redis.%s.log' % name)
+            self._spill = open(self.spill_path, 'w', encoding='utf-8')
+
+    def feed(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        line = line.rstrip('\r\n')
+        with self._lock:
+            if len(self._lines) == self._lines.maxlen:
+                self.dropped += 1
+            self._lines.append(line)
+            if self._spill is not None:
+                self._spill.write(line + '\n')
+                self._spill.flush()
+        if not self.marker_seen and READY_MARKER in line.lower():
+            self.marker_seen = True
+            self.ready.set()
+
+    def end(self):
+        """
+        Called when the output stream reaches EOF
+        """
+        self.ready.set()
+
+    def follow(self, stream):
+        """
+        Drain `stream` (a binary pipe) in a daemon thread until EOF
+        """
+
+        def run():
+            try:
+                for line in iter(stream.readline, b''):
+                    self.feed(line)
+            except (IOError, OSError, ValueError):
+                pass  # pipe closed under us
+            finally:
+                stream.close()
+                self.end()
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self, timeout=5):
+        """
+        Wait for the output to be drained (the process must have exited)
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+
+    def lines(self):
+        with self._lock:
+            return list(self._lines)
+
+    def tail(self, n=None):
+        """
+        :return: the last `n` lines (REDIS_OUTPUT_TAIL by default) as text
+        """
+        n = n or REDIS_OUTPUT_TAIL
+        lines = self.lines()[-n:]
+        skipped = self.dropped + len(self._lines) - len(lines)
+        if skipped:
+            where = ', full output in %s' % self.spill_path \
+                if self.spill_path else ''
+            lines.insert(0, '[... %d earlier lines%s]' % (skipped, where))
+        return '\n'.join(lines)
+
+    def text(self):
+        return '\n'.join(self.lines())
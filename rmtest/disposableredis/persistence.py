@@ -0,0 +1,220 @@
+# pylint: disable=missing-docstring, invalid-name
+
+"""
+Persistence round-trips verified by dataset digests.
+
+`DisposableRedis.dump_and_reload(verify=True)` captures `DEBUG DIGEST` before
+the round-trip and compares it afterwards, so serialization fidelity is
+checked in a single comparison instead of re-running every assertion. For
+datasets of up to `MAX_DIAGNOSED_KEYS` keys the `DEBUG DIGEST-VALUE` of every
+key is captured too, so a mismatch names the keys that changed.
+
+Strategies:
+
+- `rdb`: SAVE, then DEBUG RELOAD NOSAVE (or a process restart)
+- `aof`: AOF rewrite, then DEBUG LOADAOF (or a process restart)
+- `dump`: DUMP every key, then RESTORE it over itself with its TTL
+"""
+
+import time
+
+import redis
+
+STRATEGIES = ('rdb', 'aof', 'dump')
+MAX_DIAGNOSED_KEYS = 10000
+_BATCH = 1000
+
+
+class DigestMismatch(AssertionError):
+
+    def __init__(self, round_trip, changed=None):
+        self.round_trip = round_trip
+        self.changed = changed
+        message = 'Dataset changed by %s round-trip: digest %s before, %s ' \
+            'after' % (round_trip.strategy, round_trip.digest_before,
+                       round_trip.digest_after)
+        if changed:
+            message += '; changed keys: %s' % ', '.join(
+                repr(k) for k in changed[:10])
+            if len(changed) > 10:
+                message += ' and %d more' % (len(changed) - 10)
+        super(DigestMismatch, self).__init__(message)
+
+
+class RoundTrip(object):
+    """
+    Timings (in seconds) and digests of one persistence round-trip
+    """
+
+    def __init__(self, strategy, restart):
+        self.strategy = strategy
+        self.restart = restart
+        self.keys = None
+        self.save_time = None
+        self.load_time = None
+        self.digest_before = None
+        self.digest_after = None
+
+    @property
+    def verified(self):
+        return self.digest_before is not None
+
+    def __repr__(self):
+        return '<RoundTrip %s%s: %s keys, save %.3fs, load %.3fs>' % (
+            self.strategy, ' (restart)' if self.restart else '', self.keys,
+            self.save_time or 0, self.load_time or 0)
+
+
+def dataset_digest(client):
+    return client.execute_command('DEBUG', 'DIGEST')
+
+
+def key_digests(client):
+    """
+    :return: dict of key -> DEBUG DIGEST-VALUE for every key
+    """
+    digests = {}
+    batch = []
+    for key in client.scan_iter(count=_BATCH):
+        batch.append(key)
+        if len(batch) >= _BATCH:
+            digests.update(zip(batch, client.execute_command(
+                'DEBUG', 'DIGEST-VALUE', *batch)))
+            batch = []
+    if batch:
+        digests.update(zip(batch, client.execute_command(
+            'DEBUG', 'DIGEST-VALUE', *batch)))
+    return digests
+
+
+def changed_keys(before, after):
+    keys = set(before) | set(after)
+    return sorted(k for k in keys if before.get(k) != after.get(k))
+
+
+def _save_rdb(server):
+    server.client().save()
+
+
+def _load_rdb(server):
+    try:
+        server.client().execute_command('DEBUG', 'RELOAD', 'NOSAVE')
+    except redis.ResponseError:
+        # servers before 6.2 always save before reloading
+        server.client().execute_command('DEBUG', 'RELOAD')
+
+
+def _aof_enabled(client):
+    return client.config_get('appendonly').get('appendonly') == 'yes'
+
+
+def _save_aof(server, enabled):
+    client = server.client()
+    if enabled:
+        client.bgrewriteaof()
+    else:
+        # turning AOF on writes the whole dataset in a rewrite
+        client.config_set('appendonly', 'yes')
+    server._wait_for_child()
+
+
+def _load_aof(server):
+    server.client().execute_command('DEBUG', 'LOADAOF')
+
+
+def _dump_keys(server):
+    client = server.client()
+    dumps = []
+    keys = list(client.scan_iter(count=_BATCH))
+    for i in range(0, len(keys), _BATCH):
+        pipe = client.pipeline(transaction=False)
+        for key in keys[i:i + _BATCH]:
+            pipe.dump(key)
+            pipe.pttl(key)
+        replies = pipe.execute()
+        dumps += zip(keys[i:i + _BATCH], replies[::2], replies[1::2])
+    return dumps
+
+
+def _restore_keys(server, dumps):
+    client = server.client()
+    for i in range(0, len(dumps), _BATCH):
+        pipe = client.pipeline(transaction=False)
+        for key, payload, ttl in dumps[i:i + _BATCH]:
+            if payload is None:
+                continue
+            pipe.restore(key, max(ttl, 0), payload, replace=True)
+        pipe.execute()
+
+
+def _restart(server):
+    server.stop(for_restart=True)
+    server.start()
+
+
+def round_trip(server, strategy='rdb', restart=False, verify=False,
+               restart_with=_restart):
+    """
+    Run a save/load cycle on `server` and time both phases.
+
+    :param strategy: one of `STRATEGIES`
+    :param restart: load by restarting the server process instead of
+        reloading in place (rdb and aof only)
+    :param verify: compare the dataset digest before and after, raising
+        `DigestMismatch` if it changed
+    :param restart_with: called with `server` to restart its process
+    :rtype: RoundTrip
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError("Unknown persistence strategy %r" % strategy)
+    if restart and strategy == 'dump':
+        raise ValueError("The dump strategy cannot restart the server")
+    if restart and strategy == 'aof' and not server.use_aof:
+        raise ValueError("Restarting from the AOF needs use_aof=True")
+
+    result = RoundTrip(strategy, restart)
+    client = server.client()
+    result.keys = client.dbsize()
+    digests = None
+    if verify:
+        result.digest_before = dataset_digest(client)
+        if result.keys <= MAX_DIAGNOSED_KEYS:
+            digests = key_digests(client)
+
+    # an aof round-trip turns AOF on; turn it off again afterwards so the
+    # server keeps its persistence config
+    restore_aof = strategy == 'aof' and not _aof_enabled(client)
+    try:
+        begin = time.time()
+        if strategy == 'rdb':
+            _save_rdb(server)
+        elif strategy == 'aof':
+            _save_aof(server, not restore_aof)
+        else:
+            dumps = _dump_keys(server)
+        result.save_time = time.time() - begin
+
+        begin = time.time()
+        if restart:
+            restart_with(server)
+        elif strategy == 'rdb':
+            _load_rdb(server)
+        elif strategy == 'aof':
+            _load_aof(server)
+        else:
+            _restore_keys(server, dumps)
+        result.load_time = time.time() - begin
+    finally:
+        if restore_aof:
+            server.client().config_set('appendonly', 'no')
+
+    if verify:
+        client = server.client()
+        result.digest_after = dataset_digest(client)
+        if result.digest_after != result.digest_before:
+            server.errored = True
+            changed = None
+            if digests is not None:
+                changed = changed_keys(digests, key_digests(client))
+            raise DigestMismatch(result, changed)
+    return result
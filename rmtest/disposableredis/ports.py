@@ -0,0 +1,178 @@
+# pylint: disable=missing-docstring, invalid-name, broad-except
+
+"""
+Port allocation for disposable servers.
+
+Ports are checked by actually binding them (together with the cluster bus
+port, port + 10000, when needed), and handed-out ports are recorded in a
+reservation file guarded by a cross-process lock, so concurrent test workers
+on the same host never pick the same port while a server is still starting.
+A reservation lasts until the port is released or the process that owns it
+exits, however long its server runs or restarts.
+
+RMTEST_WORKER_ID (or pytest-xdist's PYTEST_XDIST_WORKER) gives each worker
+its own block of RMTEST_PORT_BLOCK ports. RMTEST_PORT_STRATEGY=ephemeral asks
+the OS for a free port instead of probing the worker's block.
+"""
+
+import atexit
+import errno
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+from rmtest.filelock import FileLock
+
+MIN_PORT = 1025
+# The cluster bus listens on port + 10000
+MAX_PORT = 65535 - 10000
+
+LOCK_FILE = os.path.join(tempfile.gettempdir(), 'rmtest-ports.lock')
+RESERVATIONS_FILE = os.path.join(tempfile.gettempdir(), 'rmtest-ports.json')
+
+
+def worker_id():
+    """
+    :return: the numeric id of this test worker, or None if not set
+    """
+    name, wid = 'RMTEST_WORKER_ID', os.environ.get('RMTEST_WORKER_ID')
+    if wid is None:
+        name = 'PYTEST_XDIST_WORKER'
+        wid = os.environ.get(name, '').lstrip('gw') or None
+    if wid is None:
+        return None
+    try:
+        return int(wid)
+    except ValueError:
+        raise ValueError("%s must be a worker number (e.g. 3 or gw3), got %r"
+                         % (name, os.environ[name]))
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def _can_bind(port):
+    sock = socket.socket()
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+class PortAllocator(object):
+
+    def __init__(self, block=None, strategy=None):
+        self.block = block or int(os.environ.get('RMTEST_PORT_BLOCK', 1000))
+        self.strategy = strategy or os.environ.get(
+            'RMTEST_PORT_STRATEGY', 'probe')
+        self.allocations = 0
+        self.conflicts = 0
+        self.lock_wait = 0.0
+
+    def port_range(self):
+        """
+        :return: (first, last) port this worker allocates from
+        """
+        wid = worker_id()
+        if wid is None:
+            return MIN_PORT, MAX_PORT
+        nblocks = (MAX_PORT - MIN_PORT + 1) // self.block
+        first = MIN_PORT + (wid % nblocks) * self.block
+        return first, first + self.block - 1
+
+    @staticmethod
+    def _load():
+        try:
+            with open(RESERVATIONS_FILE) as fp:
+                entries = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+        # a reservation is stale once its owner is gone
+        return dict((port, (pid, ts)) for port, (pid, ts) in entries.items()
+                    if pid_alive(pid))
+
+    @staticmethod
+    def _save(entries):
+        tmp = '%s.%d' % (RESERVATIONS_FILE, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(entries, fp)
+        os.rename(tmp, RESERVATIONS_FILE)
+
+    def _candidates(self, bus):
+        if self.strategy == 'ephemeral':
+            for _ in range(1000):
+                sock = socket.socket()
+                try:
+                    sock.bind(('', 0))
+                    port = sock.getsockname()[1]
+                finally:
+                    sock.close()
+                if not bus or port <= MAX_PORT:
+                    yield port
+        else:
+            first, last = self.port_range()
+            ports = list(range(first, last + 1))
+            random.shuffle(ports)
+            for port in ports:
+                yield port
+
+    def allocate(self, bus=False):
+        """
+        Reserve and return a free port.
+
+        :param bus: also require port + 10000 to be free (cluster nodes)
+        """
+        begin = time.time()
+        with FileLock(LOCK_FILE):
+            self.lock_wait += time.time() - begin
+            reserved = self._load()
+            for port in self._candidates(bus):
+                if str(port) in reserved:
+                    self.conflicts += 1
+                    continue
+                if not _can_bind(port) or (bus and not _can_bind(port + 10000)):
+                    self.conflicts += 1
+                    continue
+                reserved[str(port)] = (os.getpid(), time.time())
+                self._save(reserved)
+                self.allocations += 1
+                return port
+        raise RuntimeError("No free port in range %s-%s" % self.port_range())
+
+    def release(self, port):
+        with FileLock(LOCK_FILE):
+            reserved = self._load()
+            if reserved.pop(str(port), None) is not None:
+                self._save(reserved)
+
+    def stats(self):
+        return {'allocations': self.allocations, 'conflicts': self.conflicts,
+                'lock_wait': self.lock_wait}
+
+    def dump_stats(self, stream=None):
+        stream = stream or sys.stderr
+        stream.write("rmtest ports: {allocations} allocated, {conflicts} "
+                     "conflicts, {lock_wait:.3f}s waiting for the lock\n"
+                     .format(**self.stats()))
+
+
+PORTS = PortAllocator()
+
+
+@atexit.register
+def _report():
+    if PORTS.conflicts:
+        PORTS.dump_stats()
@@ -0,0 +1,235 @@
+# pylint: disable=missing-docstring, invalid-name, broad-except
+
+"""
+Readiness detection for disposable servers.
+
+Instead of sleeping a fixed 100ms between connection attempts, readiness is
+detected by one of several strategies:
+
+* ``log``: watch the server log (the log file, or the captured output) for
+  "Ready to accept connections"
+* ``socket``: wait for the unix socket file to appear
+* ``ping``: PING over a single raw connection, with exponential backoff
+  starting in the microsecond range
+
+Each strategy ends with a confirming PING, so a server that is still loading
+its dataset is not reported ready. ``auto`` picks the cheapest strategy the
+server configuration allows.
+
+The time to ready of every start is collected in `STARTUP_TIMES`, and a
+summary is printed at exit.
+"""
+
+import atexit
+import collections
+import os
+import sys
+import time
+
+import redis
+
+READY_MARKER = 'ready to accept connections'
+
+
+class StartupTimes(object):
+    """
+    Times to ready of the servers started by this process. Totals cover every
+    start; only the last `keep` (server path, seconds) pairs are kept.
+    """
+
+    def __init__(self, keep=1000):
+        self.recent = collections.deque(maxlen=keep)
+        self.count = 0
+        self.total = 0.0
+        self.slowest = (None, 0.0)
+
+    def add(self, path, seconds):
+        self.recent.append((path, seconds))
+        self.count += 1
+        self.total += seconds
+        if seconds > self.slowest[1]:
+            self.slowest = (path, seconds)
+
+    def stats(self):
+        return {'count': self.count, 'total': self.total,
+                'mean': self.total / self.count if self.count else 0.0,
+                'slowest': self.slowest[1], 'slowest_path': self.slowest[0]}
+
+    def report(self, stream=None):
+        if not self.count:
+            return
+        stream = stream or sys.stderr
+        stream.write("rmtest startup: {count} servers started in {total:.2f}s, "
+                     "{mean:.3f}s on average, slowest {slowest:.3f}s "
+                     "({slowest_path})\n".format(**self.stats()))
+
+
+STARTUP_TIMES = StartupTimes()
+atexit.register(STARTUP_TIMES.report)
+
+
+class ReadinessTimeout(RuntimeError):
+    pass
+
+
+def wait_for(predicate, timeout, check=None, initial=0.00005, maximum=0.1,
+             what='condition'):
+    """
+    Call `predicate` until it returns a true value, sleeping with exponential
+    backoff between calls. `check` is called after every failed attempt and
+    may raise to abort the wait.
+
+    :return: the value returned by `predicate`
+    """
+    begin = time.time()
+    delay = initial
+    while True:
+        result = predicate()
+        if result:
+            return result
+        if check:
+            check()
+        if time.time() - begin > timeout:
+            raise ReadinessTimeout(
+                "%s not reached after %s seconds" % (what, timeout))
+        time.sleep(delay)
+        delay = min(delay * 2, maximum)
+
+
+def _exited(process):
+    if process is None:
+        return False
+    if hasattr(process, 'poll'):
+        return process.poll() is not None
+    # asyncio processes have no poll()
+    return process.returncode is not None
+
+
+class _FileTail(object):
+    """
+    Incrementally read lines appended to a file which may not exist yet
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = None
+        self._partial = ''
+
+    def lines(self):
+        if self._fp is None:
+            try:
+                self._fp = open(self.path, 'r')
+            except (IOError, OSError):
+                return []
+        data = self._partial + self._fp.read()
+        lines = data.split('\n')
+        self._partial = lines.pop()
+        return lines
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class Readiness(object):
+
+    STRATEGIES = ('auto', 'log', 'socket', 'ping')
+
+    def __init__(self, server, strategy='auto', timeout=300):
+        if strategy not in self.STRATEGIES:
+            raise ValueError("Unknown readiness strategy %r" % strategy)
+        self.server = server
+        self.strategy = strategy
+        self.timeout = timeout
+        self._conn = None
+        self._begin = 0
+
+    def _resolve(self):
+        if self.strategy != 'auto':
+            return self.strategy
+        if self.server.logfile:
+            return 'log'
+        if self.server.output is not None and \
+                self.server._arg_value('loglevel') in (None, 'debug', 'verbose',
+                                                       'notice'):
+            return 'log'
+        if self.server.unix_socket_path:
+            return 'socket'
+        return 'ping'
+
+    def _check_process(self):
+        process = self.server.process
+        if _exited(process):
+            raise RuntimeError(
+                "Process has exited with code {}\n. Redis output: {}"
+                .format(process.returncode, self.server.output_tail()))
+
+    def _ping(self):
+        if self._conn is None:
+            if self.server.unix_socket_path:
+                self._conn = redis.UnixDomainSocketConnection(
+                    path=self.server.unix_socket_path)
+            else:
+                self._conn = redis.Connection(port=self.server.port)
+        try:
+            self._conn.send_command('PING')
+            self._conn.read_response()
+            return True
+        except (redis.ConnectionError, redis.ResponseError,
+                redis.TimeoutError):
+            self._conn.disconnect()
+            return False
+
+    def _wait(self, predicate, what):
+        return wait_for(predicate, self.timeout - (time.time() - self._begin),
+                        check=self._check_process, what=what)
+
+    def _wait_log(self):
+        if not self.server.logfile:
+            # also set when the output ends, i.e. the process exited
+            remaining = self.timeout - (time.time() - self._begin)
+            if not self.server.output.ready.wait(max(remaining, 0)):
+                raise ReadinessTimeout(
+                    "Log readiness marker not reached after %s seconds"
+                    % self.timeout)
+            self._check_process()
+            return
+
+        tail = _FileTail(self.server.logfile)
+        try:
+            self._wait(
+                lambda: any(READY_MARKER in line.lower()
+                            for line in tail.lines()),
+                'Log readiness marker')
+        finally:
+            tail.close()
+
+    def _wait_socket(self):
+        self._wait(lambda: os.path.exists(self.server.unix_socket_path),
+                   'Unix socket')
+
+    def wait(self):
+        """
+        Block until the server answers PING.
+
+        :return: the time to ready in seconds
+        """
+        self._begin = time.time()
+        strategy = self._resolve()
+        try:
+            if strategy == 'log':
+                self._wait_log()
+            elif strategy == 'socket':
+                self._wait_socket()
+            self._wait(self._ping, 'Server readiness')
+        except ReadinessTimeout as err:
+            raise ReadinessTimeout('%s. Redis output: %s' % (
+                err, self.server.output_tail()))
+        finally:
+            if self._conn is not None:
+                self._conn.disconnect()
+
+        elapsed = time.time() - self._begin
+        STARTUP_TIMES.add(self.server.path, elapsed)
+        return elapsed
@@ -0,0 +1,69 @@
+# pylint: disable=missing-docstring, invalid-name
+
+"""
+Client-side cluster key hashing, so keys can be routed without asking the
+server for CLUSTER KEYSLOT.
+"""
+
+import re
+
+NUM_SLOTS = 16384
+
+
+def _make_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xffff)
+    return table
+
+
+_CRC16_TABLE = _make_table()
+
+
+def crc16(data):
+    """
+    CRC16-CCITT (XMODEM), as used by Redis Cluster
+    """
+    crc = 0
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[((crc >> 8) ^ byte) & 0xff]
+    return crc
+
+
+def key_slot(key):
+    """
+    :return: the hash slot of `key`, honouring `{hashtag}` sections
+    """
+    if not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    start = key.find(b'{')
+    if start > -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key) % NUM_SLOTS
+
+
+_REDIRECT_RE = re.compile(r'^(?:(MOVED|ASK) )?(\d+) (\S*):(\d+)$')
+
+
+def parse_redirect(err):
+    """
+    :return: ('MOVED'|'ASK', slot, port) for a redirection error, else None
+    """
+    match = _REDIRECT_RE.match(str(err))
+    if not match:
+        return None
+    kind = match.group(1)
+    if kind is None:
+        name = type(err).__name__
+        if name == 'MovedError':
+            kind = 'MOVED'
+        elif name == 'AskError':
+            kind = 'ASK'
+        else:
+            return None
+    return kind, int(match.group(2)), int(match.group(4))
@@ -0,0 +1,89 @@
+# pylint: disable=missing-docstring, invalid-name
+
+"""
+Per-instance working directories.
+
+Every server started by rmtest runs with its own `--dir`, so its RDB, AOF,
+node config, log and unix socket never collide with other servers or
+workers, and everything it wrote is removed with a single `rmtree` when it
+stops. Directories are created under RMTEST_WORKDIR_ROOT, which defaults to
+/dev/shm when it is writable (keeping persistence round-trips in memory) and
+to the system temp directory otherwise.
+
+Directories are named after the pid of the test process. The first time a
+process creates one, directories left behind by processes which are no longer
+running (e.g. killed test runs) are removed.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+from .ports import pid_alive
+
+PREFIX = 'rmtest-'
+
+_swept = set()
+_lock = threading.Lock()
+
+
+def workdir_root():
+    root = os.environ.get('RMTEST_WORKDIR_ROOT')
+    if root:
+        return root
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _owner(name):
+    """
+    :return: pid of the process which created the directory `name`, or None
+        if it is not a workdir
+    """
+    if not name.startswith(PREFIX):
+        return None
+    pid = name[len(PREFIX):].split('-', 1)[0]
+    return int(pid) if pid.isdigit() else None
+
+
+def remove_stale(root):
+    """
+    Remove the workdirs under `root` whose process is gone
+
+    :return: the removed paths
+    """
+    removed = []
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return removed
+    for name in names:
+        pid = _owner(name)
+        if pid is None or pid == os.getpid() or pid_alive(pid):
+            continue
+        path = os.path.join(root, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+    return removed
+
+
+def make_workdir(root=None):
+    root = root or workdir_root()
+    with _lock:
+        if root not in _swept:
+            _swept.add(root)
+            remove_stale(root)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    path = os.path.join(root, '%s%d-%s' % (PREFIX, os.getpid(),
+                                           uuid.uuid4().hex[:12]))
+    os.mkdir(path, 0o700)
+    return path
+
+
+def remove_workdir(path):
+    shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,34 @@
+# pylint: disable=missing-docstring, invalid-name
+
+"""
+Exclusive file lock shared by the processes of a test run, e.g. parallel
+workers allocating ports or recording benchmark baselines. Without fcntl (on
+Windows) the lock is a no-op.
+"""
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+class FileLock(object):
+    """
+    Exclusive lock held across processes on `path`
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = None
+
+    def __enter__(self):
+        self._fp = open(self.path, 'a')
+        if fcntl:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+        self._fp.close()
+        self._fp = None
@@ -0,0 +1,140 @@
+# pylint: disable=missing-docstring, invalid-name, broad-except
+
+"""
+Background pool of pre-started servers.
+
+Tests which need a fresh process take an already started server from the pool
+instead of paying for the spawn and module load themselves. The pool is keyed
+by `DisposableRedis.signature` and refilled in background threads while the
+test runs; servers handed out are never returned to the pool. Only signatures
+requested more than once are pre-started, so one-off server configurations do
+not leave idle servers behind.
+"""
+
+import atexit
+import collections
+import logging as log
+import sys
+import threading
+import time
+
+from rmtest import config
+
+
+class WarmPool(object):
+
+    def __init__(self, size=0):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0
+        self._lock = threading.Lock()
+        self._ready = collections.defaultdict(collections.deque)
+        self._pending = collections.defaultdict(int)
+        self._requests = collections.defaultdict(int)
+        self._threads = []
+        self._closed = False
+        atexit.register(self.shutdown)
+
+    def acquire(self, candidate):
+        """
+        Return a started server with the same signature as `candidate`. If no
+        warm server is ready the candidate is started in the foreground.
+        """
+        if not self.size or candidate._is_external:
+            candidate.start()
+            return candidate
+
+        key = candidate.signature
+        with self._lock:
+            self._requests[key] += 1
+        server = self._take(key)
+        if server is None:
+            candidate.start()
+            server = candidate
+
+        self._refill(candidate)
+        return server
+
+    def _take(self, key):
+        while True:
+            with self._lock:
+                if not self._ready[key]:
+                    self.misses += 1
+                    return None
+                server, startup = self._ready[key].popleft()
+            # pinging a server can take a while, don't hold the lock for it
+            if server.is_alive():
+                with self._lock:
+                    self.hits += 1
+                    self.time_saved += startup
+                return server
+            try:
+                server.stop()
+            except Exception as err:
+                log.error("Error stopping dead pooled server: %s", err)
+
+    def _refill(self, template):
+        key = template.signature
+        with self._lock:
+            if self._closed or self._requests[key] < 2:
+                return
+            self._threads = [t for t in self._threads if t.is_alive()]
+            missing = self.size - len(self._ready[key]) - self._pending[key]
+            for _ in range(missing):
+                self._pending[key] += 1
+                thread = threading.Thread(target=self._spawn,
+                                          args=(template.clone(),))
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+
+    def _spawn(self, server):
+        key = server.signature
+        begin = time.time()
+        try:
+            server.start()
+        except Exception as err:
+            log.warning("Could not pre-start server: %s", err)
+            server = None
+
+        with self._lock:
+            self._pending[key] -= 1
+            if server is not None and not self._closed:
+                self._ready[key].append((server, time.time() - begin))
+                server = None
+        if server is not None:
+            server.stop()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'time_saved': self.time_saved}
+
+    def report(self, stream=None):
+        stream = stream or sys.stderr
+        stream.write(
+            "rmtest warm pool: {hits} hits, {misses} misses, "
+            "{time_saved:.2f}s of startup saved\n".format(**self.stats()))
+
+    def shutdown(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join()
+
+        for queue in self._ready.values():
+            while queue:
+                server, _ = queue.popleft()
+                try:
+                    server.stop()
+                except Exception as err:
+                    log.error("Error stopping pooled server: %s", err)
+
+        if self.hits or self.misses:
+            self.report()
+
+
+WARM_POOL = WarmPool(config.REDIS_WARM_POOL)
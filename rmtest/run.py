@@ -0,0 +1,353 @@
+# pylint: disable=missing-docstring, invalid-name, broad-except
+
+"""
+Parallel test runner.
+
+    python -m rmtest.run [-j WORKERS] [-s START_DIR] [-p PATTERN] [NAME ...]
+
+Test cases are discovered like `python -m unittest discover` (or loaded from
+the given dotted names), grouped by class so that class-level fixtures such as
+cluster setup run once, and sharded across worker processes by their duration
+in previous runs. Every worker runs in its own working directory with its own
+RMTEST_WORKER_ID (and therefore its own port block and server pools).
+
+Results, per-class timings and worker output are merged into a single
+report; timings are saved for sharding the next run. Workers spill the output
+of every server they start to their working directory (REDIS_OUTPUT_SPILL_DIR,
+unless already set), and those server logs are appended to the merged log.
+"""
+
+import argparse
+import glob
+import heapq
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import unittest
+
+from rmtest import config
+from rmtest.stats import write_report
+
+DURATIONS_FILE = '.rmtest-durations.json'
+FAILED_OUTCOMES = ('failure', 'error', 'unexpected_success')
+
+
+def _iter_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for sub in _iter_tests(test):
+                yield sub
+        else:
+            yield test
+
+
+def _class_id(test):
+    cls = type(test)
+    if cls.__module__.startswith('unittest.'):
+        # Import and loading failures are reported as a fake test whose
+        # method is named after the module that failed
+        return test._testMethodName
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def discover(args):
+    loader = unittest.TestLoader()
+    if args.names:
+        suite = loader.loadTestsFromNames(args.names)
+    else:
+        suite = loader.discover(args.start_dir, args.pattern, args.top_level_dir)
+    classes = []
+    for test in _iter_tests(suite):
+        cid = _class_id(test)
+        if cid not in classes:
+            classes.append(cid)
+    return classes
+
+
+def load_durations(path):
+    try:
+        with open(path, encoding='utf-8') as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_durations(path, durations, class_times):
+    """
+    Update the saved timings with the classes which ran this time
+    """
+    durations = dict(durations, **class_times)
+    with open(path, 'w', encoding='utf-8') as fp:
+        json.dump(durations, fp, indent=2, sort_keys=True)
+    return durations
+
+
+def shard(classes, durations, workers):
+    """
+    Assign test classes to workers, longest first, each to the currently
+    least loaded worker.
+
+    :return: list of class id lists, one per worker (possibly empty)
+    """
+    known = [durations[c] for c in classes if c in durations]
+    default = sum(known) / len(known) if known else 1.0
+    ordered = sorted(classes, key=lambda c: durations.get(c, default),
+                     reverse=True)
+
+    heap = [(0.0, i) for i in range(workers)]
+    shards = [[] for _ in range(workers)]
+    for cid in ordered:
+        load, i = heapq.heappop(heap)
+        shards[i].append(cid)
+        heapq.heappush(heap, (load + durations.get(cid, default), i))
+    return shards
+
+
+def _worker_env(worker, top_level_dir, workdir):
+    env = dict(os.environ)
+    env['RMTEST_WORKER_ID'] = str(worker)
+    env.setdefault('REDIS_OUTPUT_SPILL_DIR', os.path.join(workdir, 'servers'))
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (top_level_dir, env.get('PYTHONPATH')) if p)
+
+    # Workers run in their own directory, so pass the configuration on with
+    # absolute paths instead of relying on ./rmtest.config
+    for ent in config.entries.values():
+        if ent.value is None:
+            continue
+        value = str(ent.value)
+        if ent.env in ('REDIS_PATH', 'REDIS_MODULE_PATH') and os.sep in value:
+            value = os.path.abspath(value)
+        env[ent.env] = value
+    return env
+
+
+def run_parallel(args):
+    top_level_dir = os.path.abspath(args.top_level_dir or args.start_dir)
+    sys.path.insert(0, top_level_dir)
+
+    classes = discover(args)
+    durations = load_durations(args.durations)
+    shards = [s for s in shard(classes, durations, args.workers) if s]
+
+    begin = time.time()
+    workers = []
+    for i, class_ids in enumerate(shards):
+        workdir = tempfile.mkdtemp(prefix='rmtest-worker-%d-' % i)
+        result_file = os.path.join(workdir, 'result.json')
+        env = _worker_env(i, top_level_dir, workdir)
+        log_file = open(os.path.join(workdir, 'worker.log'), 'w',
+                        encoding='utf-8')
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'rmtest.run', '--worker', result_file] +
+            class_ids,
+            cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        workers.append((i, proc, workdir, result_file, log_file, env))
+
+    results = []
+    logs = []
+    for i, proc, workdir, result_file, log_file, env in workers:
+        proc.wait()
+        log_file.close()
+        logs.append((i, _read_logs(os.path.join(workdir, 'worker.log'),
+                                   env['REDIS_OUTPUT_SPILL_DIR'])))
+        results.append((i, proc.returncode, load_result(result_file)))
+        if not args.keep_workdirs:
+            shutil.rmtree(workdir, ignore_errors=True)
+    elapsed = time.time() - begin
+
+    tests, class_times = merge_results(results)
+    save_durations(args.durations, durations, class_times)
+
+    with open(args.log, 'w', encoding='utf-8') as fp:
+        for i, output in logs:
+            fp.write('==== worker %d ====\n%s\n' % (i, output))
+
+    report = {'elapsed': elapsed, 'workers': len(shards), 'tests': tests,
+              'classes': class_times}
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as fp:
+            json.dump(report, fp, indent=2)
+
+    return print_report(report, args.log)
+
+
+def _read_logs(worker_log, spill_dir):
+    with open(worker_log, encoding='utf-8', errors='replace') as fp:
+        parts = [fp.read()]
+    for path in sorted(glob.glob(os.path.join(spill_dir, '*.log'))):
+        with open(path, encoding='utf-8', errors='replace') as fp:
+            parts.append('---- %s ----\n%s' % (os.path.basename(path),
+                                                fp.read()))
+    return '\n'.join(parts)
+
+
+def load_result(result_file):
+    """
+    :return: the results written by a worker, or None if there are none
+    """
+    try:
+        with open(result_file, encoding='utf-8') as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def merge_results(results):
+    """
+    :param results: (worker, exit code, result or None) of every worker
+    :return: (records of all tests, duration of every test class)
+    """
+    tests = []
+    class_times = {}
+    for i, returncode, result in results:
+        if result is None:
+            result = {'tests': [{
+                'id': 'worker-%d' % i, 'outcome': 'error', 'duration': 0,
+                'details': 'Worker exited with code %s without results'
+                           % returncode}], 'classes': {}}
+        tests += result['tests']
+        class_times.update(result['classes'])
+    return tests, class_times
+
+
+def print_report(report, log_path, stream=None):
+    stream = stream or sys.stderr
+    failed = [t for t in report['tests'] if t['outcome'] in FAILED_OUTCOMES]
+    for test in failed:
+        stream.write('=' * 70 + '\n')
+        stream.write('%s: %s\n' % (test['outcome'].upper(), test['id']))
+        stream.write('-' * 70 + '\n')
+        stream.write((test.get('details') or '') + '\n')
+
+    slowest = sorted(report['classes'].items(), key=lambda kv: kv[1],
+                     reverse=True)[:5]
+    stream.write('-' * 70 + '\n')
+    stream.write('Slowest test classes:\n')
+    for cid, seconds in slowest:
+        stream.write('  %8.2fs %s\n' % (seconds, cid))
+    write_report(dict((t['id'], t['command_stats']) for t in report['tests']
+                      if t.get('command_stats')), stream)
+    stream.write('Ran %d tests in %.3fs on %d workers (output in %s)\n\n' % (
+        len(report['tests']), report['elapsed'], report['workers'], log_path))
+
+    if failed:
+        counts = {}
+        for test in failed:
+            counts[test['outcome']] = counts.get(test['outcome'], 0) + 1
+        stream.write('FAILED (%s)\n' % ', '.join(
+            '%s=%d' % kv for kv in sorted(counts.items())))
+        return 1
+    stream.write('OK\n')
+    return 0
+
+
+class _RecordingResult(unittest.TextTestResult):
+
+    def __init__(self, *args, **kwargs):
+        super(_RecordingResult, self).__init__(*args, **kwargs)
+        self.records = []
+        self._started = None
+
+    def startTest(self, test):
+        self._started = time.time()
+        super(_RecordingResult, self).startTest(test)
+
+    def _record(self, test, outcome, err=None):
+        duration = time.time() - self._started if self._started else 0
+        details = None
+        if isinstance(err, tuple):
+            details = ''.join(traceback.format_exception(*err))
+        elif err is not None:
+            details = str(err)
+        record = {'id': test.id(), 'outcome': outcome, 'duration': duration,
+                  'details': details}
+        if getattr(test, 'command_stats', None):
+            record['command_stats'] = test.command_stats
+        self.records.append(record)
+        self._started = None
+
+    def addSuccess(self, test):
+        super(_RecordingResult, self).addSuccess(test)
+        self._record(test, 'success')
+
+    def addFailure(self, test, err):
+        super(_RecordingResult, self).addFailure(test, err)
+        self._record(test, 'failure', err)
+
+    def addError(self, test, err):
+        super(_RecordingResult, self).addError(test, err)
+        self._record(test, 'error', err)
+
+    def addSkip(self, test, reason):
+        super(_RecordingResult, self).addSkip(test, reason)
+        self._record(test, 'skip', reason)
+
+    def addExpectedFailure(self, test, err):
+        super(_RecordingResult, self).addExpectedFailure(test, err)
+        self._record(test, 'expected_failure', err)
+
+    def addUnexpectedSuccess(self, test):
+        super(_RecordingResult, self).addUnexpectedSuccess(test)
+        self._record(test, 'unexpected_success')
+
+    def addSubTest(self, test, subtest, err):
+        super(_RecordingResult, self).addSubTest(test, subtest, err)
+        if err is not None:
+            failed = issubclass(err[0], test.failureException)
+            self._record(subtest, 'failure' if failed else 'error', err)
+
+
+def run_worker(result_file, class_ids):
+    loader = unittest.TestLoader()
+    result = _RecordingResult(sys.stderr, True, 1)
+    classes = {}
+    for cid in class_ids:
+        begin = time.time()
+        try:
+            suite = loader.loadTestsFromName(cid)
+        except Exception:
+            result.records.append({
+                'id': cid, 'outcome': 'error', 'duration': 0,
+                'details': traceback.format_exc()})
+            continue
+        suite.run(result)
+        classes[cid] = time.time() - begin
+
+    with open(result_file, 'w', encoding='utf-8') as fp:
+        json.dump({'tests': result.records, 'classes': classes}, fp)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m rmtest.run',
+        description='Run module tests in parallel worker processes')
+    parser.add_argument('-j', '--workers', type=int,
+                        default=os.cpu_count() if hasattr(os, 'cpu_count') else 4)
+    parser.add_argument('-s', '--start-dir', default='.')
+    parser.add_argument('-p', '--pattern', default='test*.py')
+    parser.add_argument('-t', '--top-level-dir', default=None)
+    parser.add_argument('--durations', default=DURATIONS_FILE,
+                        help='timings of previous runs, used for sharding')
+    parser.add_argument('--report', default=None,
+                        help='write the merged results as JSON to this file')
+    parser.add_argument('--log', default='rmtest-run.log',
+                        help='merged output of all workers')
+    parser.add_argument('--keep-workdirs', action='store_true')
+    parser.add_argument('--worker', metavar='RESULT_FILE', help=argparse.SUPPRESS)
+    parser.add_argument('names', nargs='*')
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        run_worker(args.worker, args.names)
+        return 0
+    return run_parallel(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+# pylint: disable=missing-docstring, invalid-name, broad-except
+
+"""
+Session-wide registry of servers shared between test cases.
+
+A shared server is started once per `DisposableRedis.signature` and reset
+between tests instead of being stopped and started again. Servers that died,
+could not be reset, or were left dirty by the module are stopped and dropped
+so that the next test gets a freshly started process.
+
+FLUSHALL only clears the keyspace, so after the reset a server is also
+compared with the module state recorded when it was first started: the loaded
+modules, and the fields of the INFO sections the modules add themselves that
+the test case lists in `module_state_fields`. Other module INFO fields are
+typically counters or memory figures, which change with every test. Every
+restart of a shared server is logged with its reason.
+"""
+
+import atexit
+import logging as log
+
+import redis
+
+
+def needs_fresh_server(obj):
+    """
+    Mark a test method (or a whole test case class) as requiring its own,
+    freshly started server even when server reuse is enabled.
+    """
+    obj.rmtest_fresh_server = True
+    return obj
+
+
+def keyspace_is_empty(client):
+    return not any(k.startswith('db') for k in client.info('keyspace'))
+
+
+def module_state(client):
+    """
+    :return: the loaded modules and the fields of the module generated INFO
+        sections (those in `INFO everything` but not in `INFO all`), as a
+        list and a dict
+    """
+    modules = sorted(str(module) for module in
+                     client.execute_command('MODULE', 'LIST'))
+    try:
+        everything = client.info('everything')
+    except redis.ResponseError:
+        # servers before 6.2 have no module generated sections
+        return modules, {}
+    builtin = client.info('all')
+    fields = dict((k, v) for k, v in everything.items() if k not in builtin)
+    return modules, fields
+
+
+class _SharedEntry(object):
+
+    def __init__(self, server):
+        self.server = server
+        client = server.client()
+        self.config = client.config_get('*')
+        self.module_state = module_state(client)
+
+    def changes(self, client, fields=()):
+        """
+        :param fields: module INFO fields which must have their start values
+        :return: how the flushed server differs from when it started, as a
+            list of messages (empty if it does not)
+        """
+        changes = []
+        if not keyspace_is_empty(client):
+            changes.append('keys left after FLUSHALL')
+        modules, values = module_state(client)
+        start_modules, start_values = self.module_state
+        if modules != start_modules:
+            changes.append('loaded modules changed from %s to %s' % (
+                start_modules, modules))
+        for field in fields:
+            if values.get(field) != start_values.get(field):
+                changes.append('module INFO field %s changed from %r to %r' % (
+                    field, start_values.get(field), values.get(field)))
+        return changes
+
+
+class SharedServers(object):
+
+    def __init__(self):
+        self._entries = {}
+        atexit.register(self.stop_all)
+
+    def acquire(self, candidate):
+        """
+        Return a running server matching the signature of `candidate`. The
+        candidate itself is started and registered if there is no usable
+        server for its signature yet.
+        """
+        key = candidate.signature
+        entry = self._entries.get(key)
+        if entry is not None and not entry.server.is_alive():
+            log.warning("Restarting shared server on port %s: it died",
+                        entry.server.port)
+            self._drop(key)
+            entry = None
+
+        if entry is None:
+            candidate.start()
+            entry = _SharedEntry(candidate)
+            self._entries[key] = entry
+
+        return entry.server
+
+    def release(self, server, is_clean=None, fields=()):
+        """
+        Reset a server after a test: FLUSHALL, CONFIG RESETSTAT and restore of
+        any CONFIG value the test changed. The server is stopped instead if
+        the reset fails, if its module state (the loaded modules and the
+        module INFO `fields`) differs from the one it started with, or if
+        `is_clean(client)` reports leftover state.
+        """
+        key = server.signature
+        entry = self._entries.get(key)
+        if entry is None or entry.server is not server:
+            server.stop()
+            return
+
+        try:
+            self._reset(entry)
+            changes = entry.changes(server.client(), fields)
+            if not changes and is_clean is not None and \
+                    not is_clean(server.client()):
+                changes = ['module_state_is_clean() returned False']
+        except redis.RedisError as err:
+            changes = ['reset failed: %s' % err]
+
+        if changes:
+            log.warning("Restarting shared server on port %s: %s",
+                        server.port, '; '.join(changes))
+            self._drop(key)
+
+    @staticmethod
+    def _reset(entry):
+        conn = entry.server.client()
+        conn.flushall()
+        conn.config_resetstat()
+
+        current = conn.config_get('*')
+        for name, value in entry.config.items():
+            if current.get(name, value) != value:
+                conn.config_set(name, value)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        try:
+            entry.server.stop()
+        except Exception as err:
+            log.error("Error stopping shared server: %s", err)
+
+    def stop_all(self):
+        for key in list(self._entries):
+            self._drop(key)
+
+
+SHARED_SERVERS = SharedServers()
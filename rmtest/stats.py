@@ -0,0 +1,180 @@
+# pylint: disable=missing-docstring, invalid-name, broad-except
+
+"""
+Per-test server-side command statistics.
+
+When enabled (RMTEST_COMMAND_STATS, or `capture_command_stats` on a test case)
+`INFO commandstats`, `INFO stats` and `SLOWLOG GET` are snapshotted on every
+server or cluster node before and after each test. The deltas are stored on
+the test as `command_stats` and collected into a report of the slowest
+commands, printed at exit (or merged by the parallel runner).
+
+INFO and SLOWLOG calls are left out of the command deltas, since the snapshots
+themselves issue them.
+"""
+
+import atexit
+import sys
+import threading
+
+import redis
+
+SLOWLOG_ENTRIES = 128
+_IGNORED_COMMANDS = ('info', 'slowlog')
+
+
+def snapshot(client):
+    """
+    :return: the raw statistics of one server
+    """
+    commands = client.info('commandstats')
+    stats = client.info('stats')
+    slowlog = client.slowlog_get(SLOWLOG_ENTRIES)
+    return {'commands': commands, 'stats': stats, 'slowlog': slowlog}
+
+
+def _counter_delta(before, after):
+    # counters go back to zero when the server restarts or on CONFIG RESETSTAT
+    return after - before if after >= before else after
+
+
+def diff(before, after):
+    """
+    :return: the statistics accumulated between two snapshots of a server:
+        `commands` maps command names to their calls and usec, `stats` holds
+        the changed `INFO stats` counters and `slowlog` the new entries
+    """
+    commands = {}
+    for key, values in after['commands'].items():
+        name = key[len('cmdstat_'):] if key.startswith('cmdstat_') else key
+        if name.split('|')[0] in _IGNORED_COMMANDS:
+            continue
+        old = before['commands'].get(key, {})
+        calls = _counter_delta(old.get('calls', 0), values.get('calls', 0))
+        if calls:
+            commands[name] = {
+                'calls': calls,
+                'usec': _counter_delta(old.get('usec', 0), values.get('usec', 0))}
+
+    stats = {}
+    for key, value in after['stats'].items():
+        if key.startswith('instantaneous_') or \
+                not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        delta = _counter_delta(before['stats'].get(key, 0), value)
+        if delta:
+            stats[key] = delta
+
+    last_id = max([entry['id'] for entry in before['slowlog']] or [-1])
+    if max([entry['id'] for entry in after['slowlog']] or [-1]) < last_id:
+        # the server was restarted and slowlog ids started over
+        last_id = -1
+    slowlog = [dict(entry) for entry in after['slowlog']
+               if entry['id'] > last_id]
+    for entry in slowlog:
+        entry.pop('client_address', None)
+        entry.pop('client_name', None)
+        if isinstance(entry.get('command'), bytes):
+            # from a client in a raw mode
+            entry['command'] = entry['command'].decode('utf-8', 'replace')
+
+    return {'commands': commands, 'stats': stats, 'slowlog': slowlog}
+
+
+def merge(diffs):
+    """
+    Combine the diffs of several cluster nodes, given as a dict of port ->
+    diff. Slowlog entries are tagged with their node's port.
+    """
+    merged = {'commands': {}, 'stats': {}, 'slowlog': [], 'nodes': diffs}
+    for port, node in diffs.items():
+        for name, values in node['commands'].items():
+            total = merged['commands'].setdefault(name, {'calls': 0, 'usec': 0})
+            total['calls'] += values['calls']
+            total['usec'] += values['usec']
+        for key, value in node['stats'].items():
+            merged['stats'][key] = merged['stats'].get(key, 0) + value
+        for entry in node['slowlog']:
+            entry = dict(entry)
+            entry['port'] = port
+            merged['slowlog'].append(entry)
+    return merged
+
+
+def snapshot_safely(client):
+    try:
+        return snapshot(client)
+    except (redis.RedisError, OSError):
+        return None
+
+
+class CommandStatsReport(object):
+
+    def __init__(self):
+        self.tests = {}
+        self._lock = threading.Lock()
+        self._registered = False
+
+    def add(self, test_id, stats):
+        with self._lock:
+            self.tests[test_id] = stats
+            if not self._registered:
+                atexit.register(self.report)
+                self._registered = True
+
+    def report(self, stream=None, limit=10):
+        if self.tests:
+            write_report(self.tests, stream or sys.stderr, limit)
+
+
+def aggregate(tests):
+    """
+    :param tests: dict of test id -> command stats
+    :return: dict of command name -> calls, usec and the test which spent the
+        most time in it
+    """
+    totals = {}
+    for test_id, stats in tests.items():
+        for name, values in stats['commands'].items():
+            total = totals.setdefault(name, {'calls': 0, 'usec': 0,
+                                             'worst_test': None,
+                                             'worst_usec': -1})
+            total['calls'] += values['calls']
+            total['usec'] += values['usec']
+            if values['usec'] > total['worst_usec']:
+                total['worst_usec'] = values['usec']
+                total['worst_test'] = test_id
+    return totals
+
+
+def write_report(tests, stream, limit=10):
+    totals = aggregate(tests)
+    if not totals:
+        return
+
+    def per_call(item):
+        return float(item[1]['usec']) / item[1]['calls']
+
+    stream.write('-' * 70 + '\n')
+    stream.write('Slowest commands by total time:\n')
+    for name, values in sorted(totals.items(), key=lambda kv: kv[1]['usec'],
+                               reverse=True)[:limit]:
+        stream.write('  %12dus %8d calls  %s (most in %s)\n' % (
+            values['usec'], values['calls'], name, values['worst_test']))
+    stream.write('Slowest commands per call:\n')
+    for name, values in sorted(totals.items(), key=per_call,
+                               reverse=True)[:limit]:
+        stream.write('  %12.2fus %8d calls  %s\n' % (
+            per_call((name, values)), values['calls'], name))
+
+    slowlog = [(entry['duration'], test_id, entry['command'])
+               for test_id, stats in tests.items()
+               for entry in stats['slowlog']]
+    if slowlog:
+        stream.write('Slowest slowlog entries:\n')
+        for duration, test_id, command in sorted(slowlog, reverse=True)[:limit]:
+            stream.write('  %12dus %s: %s\n' % (duration, test_id,
+                                                 command[:60]))
+
+
+COMMAND_STATS = CommandStatsReport()
@@ -1,14 +1,41 @@
 from subprocess import Popen
+import asyncio
+import json
+import shutil
+import tempfile
 import unittest
 import os.path
-from rmtest import ModuleTestCase
+from rmtest import ModuleTestCase, needs_fresh_server
 from rmtest.cluster import ClusterModuleTestCase
-from rmtest.disposableredis import cluster
+from rmtest.disposableredis import cluster, ports, readiness
+from rmtest.disposableredis.aio import AsyncDisposableRedis, AsyncCluster
+from rmtest.aio import AsyncModuleTestCase
+from rmtest import run
+from rmtest.pool import WarmPool
+from rmtest.shared import _SharedEntry
+from rmtest.stats import snapshot, diff
 
 
 MODULE_PATH = os.path.abspath(os.path.dirname(__file__)) + '/' + 'module.so'
 
 
+def use_temp_cache_dir(test):
+    """
+    Point RMTEST_CACHE_DIR at a temporary directory until `test` ends
+    """
+    cache_dir = tempfile.mkdtemp()
+    old = os.environ.get('RMTEST_CACHE_DIR')
+    os.environ['RMTEST_CACHE_DIR'] = cache_dir
+
+    def restore():
+        if old is None:
+            os.environ.pop('RMTEST_CACHE_DIR', None)
+        else:
+            os.environ['RMTEST_CACHE_DIR'] = old
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    test.addCleanup(restore)
+
+
 def build_module():
     csrc = MODULE_PATH[0:-3] + '.c'
     po = Popen(['cc', '-o', MODULE_PATH, '-shared', '-fPIC', csrc])
@@ -40,6 +67,384 @@ class TestTestCase(ModuleTestCase(MODULE_PATH, module_args=('foo','bar'))):
         with self.assertResponseError():
             self.cmd('TEST.ERR')
 
+    def testUnixSocket(self):
+        with self.redis(unixsocket_only=True) as r:
+            self.assertTrue(r.connection_pool.connection_kwargs['path'])
+            self.assertOk(r.execute_command('TEST.TEST'))
+
+    def testConnectionReuse(self):
+        for _ in range(10):
+            self.assertIs(self.client, self.server.client())
+            self.cmd('PING')
+        self.assertEqual({'opened': 1, 'reused': 9},
+                         self.server.connection_stats())
+
+    def testFixture(self):
+        def seed(test):
+            for i in range(100):
+                test.cmd('SET', 'key:%d' % i, i)
+
+        use_temp_cache_dir(self)
+        for link in ('copy', 'hardlink'):
+            self.load_fixture(seed, link=link)
+            self.assertEqual(100, self.cmd('DBSIZE'))
+            self.assertEqual('42', self.cmd('GET', 'key:42'))
+
+    def testBulkLoad(self):
+        for mode in ('pipeline', 'resp'):
+            self.cmd('FLUSHALL')
+            res = self.bulk_load((('SET', 'key:%d' % i, i) for i in range(10000)),
+                                 batch_size=500, mode=mode)
+            self.assertEqual(10000, res.commands)
+            self.assertEqual(20, res.batches)
+            self.assertEqual(0, res.failed)
+            self.assertEqual(10000, self.cmd('DBSIZE'))
+
+        res = self.bulk_load([('SET', 'foo', 'bar'), ('TEST.ERR',)], mode='resp')
+        self.assertEqual(1, res.failed)
+
+    def testBenchmark(self):
+        res = self.benchmark('TEST.TEST', iterations=200, warmup=10, rounds=2)
+        self.assertEqual(400, res.ops)
+        self.assertTrue(0 < res.p50 <= res.p99 <= res.max)
+        res = self.benchmark('PING', iterations=50, pipeline=10, rounds=1)
+        self.assertEqual(500, res.ops)
+        self.assertLatency(('TEST.TEST',), below_ms=1000, baseline=False)
+        self.assertThroughput(('TEST.TEST',), min_ops=1, baseline=False)
+        with self.assertRaises(AssertionError):
+            self.assertThroughput(('PING',), min_ops=1e12, baseline=False,
+                                  iterations=10)
+
+    def testLoad(self):
+        res = self.run_load([(3, ('SET', '{key}', 'x')), (1, ('GET', '{key}'))],
+                            clients=4, processes=2, ops=1000,
+                            distribution='zipfian', keyspace=100)
+        self.assertEqual(1000, res.ops)
+        self.assertEqual(0, res.errors)
+        self.assertEqual(set(['SET', 'GET']), set(res.commands))
+        self.assertGreater(res.histogram.percentile(99), 0)
+
+    def testCommandStats(self):
+        before = snapshot(self.client)
+        for _ in range(5):
+            self.cmd('TEST.TEST')
+        stats = diff(before, snapshot(self.client))
+        self.assertEqual(5, stats['commands']['test.test']['calls'])
+        self.assertNotIn('info', stats['commands'])
+        self.assertGreaterEqual(stats['stats']['total_commands_processed'], 5)
+
+    def testMemory(self):
+        self.assertMemoryBelow(1 << 30)
+        with self.assertRaises(AssertionError):
+            self.assertMemoryBelow(1)
+        self.bulk_load(('SET', 'key:%d' % i, 'x' * 100) for i in range(1000))
+        values = self.assertNoLeakAcrossReloads(3)
+        self.assertEqual(3, len(values))
+
+    def testVerifiedReload(self):
+        self.bulk_load(('SET', 'key:%d' % i, i) for i in range(100))
+        self.cmd('EXPIRE', 'key:1', 1000)
+        trips = self.assertDatasetSurvives('rdb', 'aof', 'dump')
+        self.assertEqual(['rdb', 'aof', 'dump'], [t.strategy for t in trips])
+        for trip in trips:
+            self.assertEqual(100, trip.keys)
+            self.assertEqual(trip.digest_before, trip.digest_after)
+            self.assertIsNotNone(trip.load_time)
+        self.assertGreater(self.cmd('TTL', 'key:1'), 0)
+        self.assertEqual(trips, self.server.round_trips[-3:])
+        # the aof round-trip leaves the persistence config as it was
+        self.assertEqual('no', self.client.config_get('appendonly')['appendonly'])
+
+    def testOutputCapture(self):
+        output = self.server.output
+        if output is None:
+            self.skipTest('Server output is not captured with REDIS_VERBOSE')
+        self.assertTrue(output.marker_seen)
+        self.assertTrue(any('ready to accept connections' in line.lower()
+                            for line in output.lines()))
+        self.assertLessEqual(len(self.server.output_tail(2).splitlines()), 3)
+
+    def testClientModes(self):
+        blob = b'\xff\xfe' * 1000
+        self.cmd('SET', 'blob', blob)
+        self.client.rpush('big', *range(1000))
+        raw = self.server.client('raw')
+        self.assertEqual(blob, raw.get('blob'))
+        self.assertOk(raw.execute_command('TEST.TEST'))
+        results = self.benchmark_client_modes('LRANGE', 'big', 0, -1,
+                                              iterations=20, warmup=5,
+                                              rounds=1)
+        self.assertIn('raw', results)
+        self.assertIn('decoded', results)
+
+    def testBatch(self):
+        with self.batch() as b:
+            for i in range(100):
+                b.cmd('SET', 'key:%d' % i, i)
+            b.assertEqual('7', 'GET', 'key:7')
+            b.assertCmdOk('TEST.TEST')
+            b.assertResponseError('TEST.ERR')
+        self.assertEqual(103, len(b.replies))
+
+        with self.assertRaises(AssertionError) as ctx:
+            with self.batch() as b:
+                b.assertEqual('0', 'GET', 'key:1')
+                b.assertCmdOk('TEST.TEST')
+                b.assertResponseError('GET', 'key:1')
+        self.assertIn('2 of 3 batched commands failed', str(ctx.exception))
+        self.assertIn('#0 GET key:1', str(ctx.exception))
+        self.assertIn('#2 GET key:1', str(ctx.exception))
+
+    def testWorkdir(self):
+        with self.redis() as r:
+            workdir = r.dr.workdir
+            self.assertEqual(workdir, r.config_get('dir')['dir'])
+            r.save()
+            self.assertTrue(os.path.exists(r.dr.rdb_path))
+            self.assertEqual(workdir, os.path.dirname(r.dr.rdb_path))
+        self.assertFalse(os.path.exists(workdir))
+
+    def testStartupTime(self):
+        self.assertGreater(self.server.startup_time, 0)
+        self.assertEqual([self.server.startup_time], self.server.startup_times)
+        self.assertIn((self.server.path, self.server.startup_time),
+                      readiness.STARTUP_TIMES.recent)
+
+
+class ReuseTestCase(ModuleTestCase(MODULE_PATH, module_args=('foo','bar'))):
+    reuse_server = True
+
+    @classmethod
+    def setUpClass(cls):
+        super(ReuseTestCase, cls).setUpClass()
+        if not os.path.exists(MODULE_PATH):
+            build_module()
+
+    def testServerIsShared(self):
+        server = self.server
+        self.cmd('SET', 'foo', 'bar')
+        self.cmd('CONFIG', 'SET', 'maxmemory-policy', 'allkeys-lru')
+        self.tearDown()
+
+        self.assertIs(server, self.server)
+        self.assertEqual(0, self.cmd('DBSIZE'))
+        self.assertEqual('noeviction',
+                         self.client.config_get('maxmemory-policy')['maxmemory-policy'])
+
+    @needs_fresh_server
+    def testFreshServer(self):
+        self.assertTrue(self.server)
+        self.assertFalse(self._shared)
+
+
+class PortsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = ports.LOCK_FILE, ports.RESERVATIONS_FILE
+        ports.LOCK_FILE = os.path.join(self.tmpdir, 'ports.lock')
+        ports.RESERVATIONS_FILE = os.path.join(self.tmpdir, 'ports.json')
+        self.env = dict((k, os.environ.pop(k, None))
+                        for k in ('RMTEST_WORKER_ID', 'PYTEST_XDIST_WORKER'))
+
+    def tearDown(self):
+        ports.LOCK_FILE, ports.RESERVATIONS_FILE = self.files
+        shutil.rmtree(self.tmpdir)
+        for k, v in self.env.items():
+            os.environ.pop(k, None)
+            if v is not None:
+                os.environ[k] = v
+
+    def reservations(self):
+        with open(ports.RESERVATIONS_FILE, encoding='utf-8') as fp:
+            return json.load(fp)
+
+    def testAllocate(self):
+        allocator = ports.PortAllocator(block=10)
+        os.environ['RMTEST_WORKER_ID'] = '3'
+        first, last = allocator.port_range()
+        self.assertEqual((ports.MIN_PORT + 30, ports.MIN_PORT + 39), (first, last))
+
+        allocated = [allocator.allocate() for _ in range(3)]
+        self.assertEqual(3, len(set(allocated)))
+        for port in allocated:
+            self.assertTrue(first <= port <= last)
+        self.assertEqual(sorted(str(p) for p in allocated), sorted(self.reservations()))
+
+        allocator.release(allocated[0])
+        self.assertNotIn(str(allocated[0]), self.reservations())
+
+    def testWorkerId(self):
+        self.assertIsNone(ports.worker_id())
+        os.environ['PYTEST_XDIST_WORKER'] = 'gw5'
+        self.assertEqual(5, ports.worker_id())
+        os.environ['RMTEST_WORKER_ID'] = 'yes'
+        with self.assertRaises(ValueError):
+            ports.worker_id()
+
+    def testStaleReservation(self):
+        dead = Popen(['true'])
+        dead.wait()
+        with open(ports.RESERVATIONS_FILE, 'w', encoding='utf-8') as fp:
+            json.dump({'2000': [dead.pid, 0], '2001': [os.getpid(), 0]}, fp)
+        # old reservations of a live process are kept, those of a dead one dropped
+        self.assertEqual(['2001'], list(ports.PortAllocator._load()))
+
+
+class _PooledServer(object):
+    _is_external = False
+
+    def __init__(self, signature='sig'):
+        self.signature = signature
+        self.started = self.stopped = False
+        self.alive = True
+
+    def clone(self):
+        return _PooledServer(self.signature)
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.stopped = True
+
+    def is_alive(self):
+        return self.alive
+
+
+class WarmPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = WarmPool(size=2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def wait_refill(self):
+        for thread in self.pool._threads:
+            thread.join()
+
+    def testCheckoutAndRefill(self):
+        first = _PooledServer()
+        self.assertIs(first, self.pool.acquire(first))
+        self.assertTrue(first.started)
+        # a signature requested once is not pre-started
+        self.wait_refill()
+        self.assertEqual(0, len(self.pool._ready['sig']))
+
+        second = _PooledServer()
+        self.assertIs(second, self.pool.acquire(second))
+        self.wait_refill()
+        self.assertEqual(2, len(self.pool._ready['sig']))
+
+        third = _PooledServer()
+        server = self.pool.acquire(third)
+        self.assertIsNot(third, server)
+        self.assertTrue(server.started)
+        self.assertFalse(third.started)
+        self.assertEqual((1, 2), (self.pool.hits, self.pool.misses))
+
+        self.wait_refill()
+        self.assertEqual(2, len(self.pool._ready['sig']))
+        self.assertEqual(0, len(self.pool._ready['other']))
+
+    def testDeadServerIsSkipped(self):
+        for _ in range(2):
+            self.pool.acquire(_PooledServer())
+        self.wait_refill()
+        dead, alive = [server for server, _ in self.pool._ready['sig']]
+        dead.alive = False
+
+        self.assertIs(alive, self.pool.acquire(_PooledServer()))
+        self.assertTrue(dead.stopped)
+
+    def testShutdownStopsIdleServers(self):
+        for _ in range(2):
+            self.pool.acquire(_PooledServer())
+        self.wait_refill()
+        idle = [server for server, _ in self.pool._ready['sig']]
+        self.pool.shutdown()
+        self.assertTrue(all(server.stopped for server in idle))
+
+
+class _InfoClient(object):
+    def __init__(self):
+        self.keyspace = {}
+        self.modules = ['mod']
+        self.fields = {'mod_calls': 1, 'mod_open_handles': 0}
+
+    def info(self, section):
+        if section == 'keyspace':
+            return self.keyspace
+        if section == 'everything':
+            return dict(self.fields, used_memory=100)
+        return {'used_memory': 100}
+
+    def execute_command(self, *args):
+        return self.modules
+
+    def config_get(self, pattern):
+        return {}
+
+
+class _InfoServer(object):
+    def __init__(self):
+        self._client = _InfoClient()
+
+    def client(self):
+        return self._client
+
+
+class SharedServersTestCase(unittest.TestCase):
+    def testModuleStateChanges(self):
+        entry = _SharedEntry(_InfoServer())
+        client = entry.server.client()
+        client.fields['mod_calls'] = 5
+        # counters are only compared when listed
+        self.assertEqual([], entry.changes(client))
+        self.assertEqual([], entry.changes(client, ['mod_open_handles']))
+
+        client.fields['mod_open_handles'] = 2
+        client.keyspace = {'db0': {'keys': 1}}
+        client.modules = []
+        self.assertEqual(3, len(entry.changes(client, ['mod_open_handles'])))
+
+
+class RunnerTestCase(unittest.TestCase):
+    def testShard(self):
+        durations = {'a': 10, 'b': 6, 'c': 5, 'd': 1}
+        shards = run.shard(['d', 'c', 'b', 'a', 'new'], durations, 2)
+        # longest first, each to the least loaded worker; unknown classes
+        # count as the mean duration
+        self.assertEqual([['a', 'c'], ['b', 'new', 'd']], shards)
+        self.assertEqual([['a'], [], []], run.shard(['a'], durations, 3))
+
+    def testMergeResults(self):
+        first = {'tests': [{'id': 'A.test', 'outcome': 'success'}],
+                 'classes': {'A': 1.5}}
+        second = {'tests': [{'id': 'B.test', 'outcome': 'failure'}],
+                  'classes': {'B': 2.5}}
+        tests, classes = run.merge_results(
+            [(0, 0, first), (1, 1, second), (2, -9, None)])
+        self.assertEqual(['A.test', 'B.test', 'worker-2'],
+                         [t['id'] for t in tests])
+        self.assertEqual('error', tests[2]['outcome'])
+        self.assertIn('code -9', tests[2]['details'])
+        self.assertEqual({'A': 1.5, 'B': 2.5}, classes)
+
+    def testDurationsFile(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, run.DURATIONS_FILE)
+            self.assertEqual({}, run.load_durations(path))
+            run.save_durations(path, {}, {'A': 1.0, 'B': 2.0})
+            run.save_durations(path, run.load_durations(path), {'B': 3.0})
+            self.assertEqual({'A': 1.0, 'B': 3.0}, run.load_durations(path))
+
+            with open(path, 'w', encoding='utf-8') as fp:
+                fp.write('{not json')
+            self.assertEqual({}, run.load_durations(path))
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 class ClusterTestCase(unittest.TestCase):
     @classmethod
@@ -50,6 +455,8 @@ class ClusterTestCase(unittest.TestCase):
             build_module()
 
     def setUp(self):
+        # templates are saved in the cache, keep them out of ~/.cache
+        use_temp_cache_dir(self)
         self.cl = cluster.Cluster(num_nodes=3)
 
     def testCluster(self):
@@ -57,9 +464,40 @@ class ClusterTestCase(unittest.TestCase):
 
         self.assertEqual(3, len(ports))
 
-        res = self.cl.broadcast('ping')
-        self.assertListEqual(['PONG', 'PONG', 'PONG'], res)
+        res = self.cl.broadcast('ECHO', 'hi')
+        self.assertListEqual(ports, list(res))
+        self.assertListEqual(['hi', 'hi', 'hi'], list(res.values()))
+
+        res = self.cl.broadcast('NOSUCHCOMMAND')
+        self.assertEqual(3, len(res.errors))
+        with self.assertRaises(cluster.BroadcastError):
+            res.check()
+
+        # redis-py maps the PING reply to True
+        res = self.cl.broadcast_pipeline([('ping',), ('ECHO', 'foo')])
+        self.assertListEqual([[True, 'foo']] * 3, list(res.values()))
+
+        self.assertEqual(3, len(self.cl.startup_times))
+        for startup_time in self.cl.startup_times:
+            self.assertGreater(startup_time, 0)
+        self.assertListEqual(['slots', 'meet', 'converge'],
+                             list(self.cl.bootstrap_times))
     
+    def testClusterTemplate(self):
+        self.cl.stop()
+        for attempt in range(2):
+            self.cl = cluster.Cluster(num_nodes=3, template=True)
+            self.cl.start()
+            self.assertEqual(['hi'] * 3,
+                             list(self.cl.broadcast('ECHO', 'hi').values()))
+            if attempt:
+                # the first start saved the template if there was none
+                self.assertTrue(self.cl.from_template)
+                self.assertIn('template', self.cl.bootstrap_times)
+                self.assertTrue(self.cl.key_command('SET', 'foo', 'bar'))
+                self.assertEqual('bar', self.cl.key_command('GET', 'foo'))
+            self.cl.stop()
+
     def tearDown(self):
         self.cl.stop()
         
@@ -79,5 +517,79 @@ class ClusterTestCaseWithModule(ClusterModuleTestCase(MODULE_PATH, num_nodes=5,
             with self.assertResponseError():
                 client.execute_command('TEST.ERR')
 
+    def testKeyRouting(self):
+        node = self.client_for_key('foobar')
+        self.assertTrue(self.key_cmd('SET', 'foobar', 'baz'))
+        self.assertEqual('baz', node.get('foobar'))
+
+    def testBulkLoad(self):
+        res = self.bulk_load(('SET', 'key:%d' % i, i) for i in range(1000))
+        self.assertEqual(1000, res.commands)
+        self.assertEqual(0, res.failed)
+        self.assertEqual('42', self.key_cmd('GET', 'key:42'))
+
+    def testRunLoad(self):
+        res = self.run_load([(1, ('GET', '{key}'))], clients=2, ops=300)
+        self.assertEqual(0, res.errors)
+        # every node serves part of the keyspace
+        self.assertEqual(set(self._ports), set(res.nodes))
+
+    def testBatch(self):
+        with self.batch() as b:
+            for i in range(100):
+                b.cmd('SET', 'batch:%d' % i, i)
+            for i in range(100):
+                b.assertEqual(str(i), 'GET', 'batch:%d' % i)
+        self.assertEqual('42', self.key_cmd('GET', 'batch:42'))
+
+    def _cycle_keys(self):
+        # other tests share this cluster, so only count the keys of this one
+        keys = set()
+        for node in self._cluster.nodes:
+            keys.update(node.client().scan_iter('cycle:*', count=1000))
+        return keys
+
+    def testPersistenceCycle(self):
+        self.bulk_load(('SET', 'cycle:%d' % i, i) for i in range(1000))
+        keys = self._cycle_keys()
+        self.assertEqual(1000, len(keys))
+        for _ in self.retry_with_rdb_reload(restart=True, verify=True):
+            self.assertEqual('42', self.key_cmd('GET', 'cycle:42'))
+            self.assertEqual(keys, self._cycle_keys())
+        trips = self.persistence_cycles[0]
+        self.assertEqual(set(self._ports), set(trips))
+        self.assertGreaterEqual(sum(trip.keys for trip in trips.values()), 1000)
+        for trip in trips.values():
+            self.assertGreater(trip.save_time, 0)
+            self.assertGreater(trip.load_time, 0)
+
+class AsyncTestCase(AsyncModuleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(AsyncTestCase, cls).setUpClass()
+        if not os.path.exists(MODULE_PATH):
+            build_module()
+
+    def redis(self, **kwargs):
+        return AsyncDisposableRedis(loadmodule=[MODULE_PATH, 'foo', 'bar'], **kwargs)
+
+    async def testConcurrentCommands(self):
+        replies = await asyncio.gather(*(self.cmd('TEST.TEST') for _ in range(100)))
+        for reply in replies:
+            self.assertOk(reply)
+        with self.assertResponseError():
+            await self.cmd('TEST.ERR')
+
+    async def testCluster(self):
+        cl = AsyncCluster(num_nodes=3)
+        ports = await cl.start()
+        try:
+            res = await cl.broadcast('ECHO', 'foo')
+            self.assertListEqual(ports, list(res))
+            self.assertListEqual(['foo'] * 3, list(res.values()))
+        finally:
+            await cl.stop()
+
+
 if __name__ == '__main__':
     unittest.main()